@@ -0,0 +1,256 @@
+"""
+Summarize a lot of recorded runs at once: how far the Roomba went, how much it turned, how often it
+bumped into things or found cliffs, and how long it spent stuck.
+
+Each run (a movement directory, .fmov file, or movement.json) is read a chunk at a time, and each
+chunk is added up with NumPy, so memory use doesn't depend on how long the run is. Runs are spread
+over a process per core, and each run's totals are cached by its size and modification time, so
+going over an archive again only reads the runs that are new or still being recorded.
+
+python3 analyze_runs.py runs/ --json
+
+Times come from each sample's duration (older samples without one are movement_log.DEFAULT_DURATION
+long). Stuck means not moving or turning while bumping or at a cliff.
+"""
+import argparse
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import ujson
+
+from interface import MM_PER_COUNT
+from movement_binary import BUMPER_WHEEL_DROP, CLIFF, LIGHT_BUMPER, MovementFile
+from movement_log import DEFAULT_DURATION, read_movement, segment_paths
+
+CHUNK_SIZE = 65536
+"""How many samples to add up at a time"""
+CACHE_VERSION = 3
+"""Change this when the totals change, so old cached ones aren't used"""
+EVENTS = ("bumper_wheel_drop", "cliff", "light_bumper")
+
+
+def find_runs(paths: list) -> list:
+    """Find every run in these paths (looking through folders for them)"""
+    runs = []
+    for path in paths:
+        if not os.path.isdir(path) or segment_paths(path):
+            runs.append(path)
+            continue
+        for directory, subdirectories, files in os.walk(path):
+            subdirectories.sort()
+            for subdirectory in list(subdirectories):
+                if segment_paths(os.path.join(directory, subdirectory)):
+                    runs.append(os.path.join(directory, subdirectory))
+                    # A movement directory is one run, so don't look inside it
+                    subdirectories.remove(subdirectory)
+            for name in sorted(files):
+                if name.endswith(".fmov") or (name.endswith(".json") and "movement" in name):
+                    runs.append(os.path.join(directory, name))
+    return runs
+
+
+def fingerprint(path: str) -> list:
+    """Something that changes whenever the run does"""
+    if os.path.isdir(path):
+        return [
+            [os.path.basename(segment), stat.st_size, stat.st_mtime_ns]
+            for segment in segment_paths(path)
+            for stat in (os.stat(segment),)
+        ]
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _columns(samples: list) -> dict:
+    return {
+        "encoder_delta": np.fromiter(
+            (sample["encoder_delta"] for sample in samples), np.int64, len(samples)
+        ),
+        "degrees_turned": np.fromiter(
+            (sample["degrees_turned"] for sample in samples), np.int64, len(samples)
+        ),
+        "duration": np.fromiter(
+            (sample.get("duration", DEFAULT_DURATION) for sample in samples),
+            np.float64,
+            len(samples),
+        ),
+        **{
+            event: np.fromiter((sample[event] for sample in samples), bool, len(samples))
+            for event in EVENTS
+        },
+    }
+
+
+def read_chunks(path: str, chunk_size: int = CHUNK_SIZE):
+    """Go through a run a chunk at a time, as a NumPy array for each column"""
+    if path.endswith(".fmov"):
+        with MovementFile(path) as movement_file:
+            for start in range(0, len(movement_file), chunk_size):
+                records = movement_file.records[start : start + chunk_size]
+                flags = records["flags"]
+                yield {
+                    "encoder_delta": records["encoder_delta"].astype(np.int64),
+                    "degrees_turned": records["degrees_turned"].astype(np.int64),
+                    "bumper_wheel_drop": (flags & BUMPER_WHEEL_DROP) != 0,
+                    "cliff": (flags & CLIFF) != 0,
+                    "light_bumper": (flags & LIGHT_BUMPER) != 0,
+                    "duration": (
+                        records["duration_ms"] / 1000
+                        if movement_file.version >= 2
+                        else np.full(len(records), DEFAULT_DURATION)
+                    ),
+                }
+                # Let go of the views, so the file can be unmapped
+                del records, flags
+        return
+    if os.path.isdir(path):
+        samples = read_movement(path)
+    else:
+        # An old movement.json is one big list, so it has to be loaded all at once
+        with open(path) as f:
+            samples = iter(ujson.load(f))
+    while True:
+        chunk = list(itertools.islice(samples, chunk_size))
+        if not chunk:
+            return
+        yield _columns(chunk)
+
+
+def analyze_run(path: str, chunk_size: int = CHUNK_SIZE) -> dict:
+    """Add up the totals for one run"""
+    totals = {
+        "samples": 0,
+        "seconds": 0.0,
+        "encoder_counts": 0,
+        "degrees_turned": 0,
+        "stuck_seconds": 0.0,
+        **{event: 0 for event in EVENTS},
+    }
+    previous = {event: False for event in EVENTS}
+    for chunk in read_chunks(path, chunk_size):
+        encoder_delta = chunk["encoder_delta"]
+        degrees_turned = chunk["degrees_turned"]
+        totals["samples"] += len(encoder_delta)
+        totals["seconds"] += float(chunk["duration"].sum())
+        totals["encoder_counts"] += int(np.abs(encoder_delta).sum())
+        totals["degrees_turned"] += int(np.abs(degrees_turned).sum())
+        for event in EVENTS:
+            # Only count it when it starts, not every sample it's still going
+            flags = chunk[event]
+            started = flags & ~np.concatenate(([previous[event]], flags[:-1]))
+            totals[event] += int(np.count_nonzero(started))
+            previous[event] = bool(flags[-1])
+        blocked = chunk["bumper_wheel_drop"] | chunk["cliff"]
+        still = (encoder_delta == 0) & (degrees_turned == 0)
+        totals["stuck_seconds"] += float(chunk["duration"][blocked & still].sum())
+    return totals
+
+
+def summarize(totals: dict) -> dict:
+    """Turn a run's totals into distances, times, and rates"""
+    hours = totals["seconds"] / 3600
+    summary = {
+        "hours": hours,
+        # encoder_delta adds up both wheels, so halve it to get how far the middle went
+        "distance_m": totals["encoder_counts"] / 2 * MM_PER_COUNT / 1000,
+        "turned_degrees": totals["degrees_turned"],
+        "stuck_seconds": totals["stuck_seconds"],
+    }
+    for event in EVENTS:
+        summary[event] = totals[event]
+        summary[f"{event}_per_hour"] = totals[event] / hours if hours else 0
+    return summary
+
+
+def load_cache(path: str) -> dict:
+    try:
+        with open(path) as f:
+            cache = ujson.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if cache.get("version") != CACHE_VERSION:
+        return {}
+    return cache["runs"]
+
+
+def save_cache(path: str, runs: dict):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as f:
+        ujson.dump({"version": CACHE_VERSION, "runs": runs}, f)
+    os.replace(temporary_path, path)
+
+
+def analyze_runs(runs: list, cache_path: str = None, jobs: int = None, chunk_size=CHUNK_SIZE):
+    """Get the totals for every run, only reading the ones that aren't cached"""
+    cache = load_cache(cache_path) if cache_path else {}
+    results = {}
+    stale = []
+    for run in runs:
+        key = os.path.abspath(run)
+        current = fingerprint(run)
+        cached = cache.get(key)
+        if cached is not None and cached["fingerprint"] == current:
+            results[run] = cached["totals"]
+        else:
+            stale.append((run, key, current))
+    if len(stale) > 1 and jobs != 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            totals = list(
+                pool.map(analyze_run, [run for run, _, _ in stale], itertools.repeat(chunk_size))
+            )
+    else:
+        totals = [analyze_run(run, chunk_size) for run, _, _ in stale]
+    for (run, key, current), run_totals in zip(stale, totals):
+        results[run] = run_totals
+        cache[key] = {"fingerprint": current, "totals": run_totals}
+    if cache_path and stale:
+        save_cache(cache_path, cache)
+    return {run: results[run] for run in runs}, len(stale)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize recorded runs")
+    parser.add_argument("paths", nargs="+", help="runs, or folders with runs in them")
+    parser.add_argument("--cache", default=".analytics_cache.json", help="'' to not cache")
+    parser.add_argument("-j", "--jobs", type=int, help="how many processes (default: one a core)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    args = parser.parse_args()
+
+    runs = find_runs(args.paths)
+    results, analyzed = analyze_runs(runs, args.cache or None, args.jobs, args.chunk_size)
+    summaries = {run: summarize(totals) for run, totals in results.items()}
+    overall = {
+        name: sum(totals[name] for totals in results.values())
+        for name in (
+            "samples",
+            "seconds",
+            "encoder_counts",
+            "degrees_turned",
+            "stuck_seconds",
+            *EVENTS,
+        )
+    }
+    if args.json:
+        output = {"runs": summaries, "total": summarize(overall)}
+        print(ujson.dumps(output, indent=2, escape_forward_slashes=False))
+        return
+
+    print(
+        f"{'run':40} {'hours':>7} {'meters':>8} {'turned':>9} {'bumps/h':>8} {'cliffs/h':>8}"
+        f" {'light/h':>8} {'stuck s':>8}"
+    )
+    for run, summary in itertools.chain(summaries.items(), [("total", summarize(overall))]):
+        print(
+            f"{run[-40:]:40} {summary['hours']:7.2f} {summary['distance_m']:8.1f}"
+            f" {summary['turned_degrees']:9} {summary['bumper_wheel_drop_per_hour']:8.1f}"
+            f" {summary['cliff_per_hour']:8.1f} {summary['light_bumper_per_hour']:8.1f}"
+            f" {summary['stuck_seconds']:8.1f}"
+        )
+    print(f"({analyzed} of {len(runs)} runs read, the rest were cached)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""
+Benchmark the bridge's hot paths against simulator.py, and save the results to compare runs.
+
+- command_latency: from publishing to roomba/command to the first byte on the serial port
+- find_state: how long find_state() takes, and how long a SEND_SENSORS round trip takes
+- recorder: how many sensor frames per second come in, and how many samples per second get logged
+- visualize: how long loading and rendering a log takes as it gets bigger
+
+python3 bench.py -o bench_results.json
+"""
+import argparse
+import asyncio
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+import ujson
+
+import local_mqtt
+import server
+from interface import OPCODE_START, sensor_layout
+from movement_binary import MovementWriter
+from movement_log import MovementLog
+from session import RoombaSession
+from simulator import RoombaSimulator
+
+
+def summarize(samples: list) -> dict:
+    """Work out the usual stats for a list of times (in seconds), in milliseconds"""
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "min_ms": samples[0] * 1000,
+        "median_ms": statistics.median(samples) * 1000,
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        "max_ms": samples[-1] * 1000,
+        "mean_ms": statistics.fmean(samples) * 1000,
+    }
+
+
+async def _command_latency(simulator: RoombaSimulator, iterations: int) -> list:
+    broker = local_mqtt.LocalBroker()
+    ha = broker.Client("roomba")
+    ha.connect()
+    home_assistant = broker.Client("home_assistant")
+    home_assistant.connect()
+    session = RoombaSession(simulator.port)
+    bridge = server.Bridge(session, ha)
+    task = asyncio.create_task(bridge.run())
+    while bridge.loop is None or session.latest() is None:
+        await asyncio.sleep(0.01)
+
+    received = threading.Event()
+    first_byte = []
+
+    def on_receive(received_at, _data):
+        if not received.is_set():
+            first_byte.append(received_at)
+            received.set()
+
+    simulator.on_receive = on_receive
+    latencies = []
+    loop = asyncio.get_running_loop()
+    for index in range(iterations):
+        received.clear()
+        first_byte.clear()
+        sent_at = time.perf_counter()
+        home_assistant.publish("roomba/command", "start" if index % 2 else "return_to_base")
+        if await loop.run_in_executor(None, received.wait, 2):
+            latencies.append(first_byte[0] - sent_at)
+        await asyncio.sleep(0.02)
+    simulator.on_receive = None
+    task.cancel()
+    session.close()
+    return latencies
+
+
+def bench_command_latency(iterations: int) -> dict:
+    simulator = RoombaSimulator().start()
+    try:
+        latencies = asyncio.run(_command_latency(simulator, iterations))
+    finally:
+        simulator.stop()
+    return summarize(latencies)
+
+
+def bench_find_state(iterations: int) -> dict:
+    simulator = RoombaSimulator().start()
+    try:
+        session = RoombaSession(simulator.port)
+        bridge = server.Bridge(session, local_mqtt.Client())
+        session.start()
+        find_state = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            bridge.find_state()
+            find_state.append(time.perf_counter() - started)
+        session.close()
+
+        # For comparison, asking for the same packets and waiting for the reply
+        session = RoombaSession(simulator.port)
+        session.write(OPCODE_START)
+        time.sleep(0.05)
+        layout = sensor_layout(server.STATE_PACKETS)
+        session.roomba.reset_input_buffer()
+        query = []
+        missed = 0
+        for _ in range(iterations):
+            started = time.perf_counter()
+            if layout.query(session.roomba) is None:
+                missed += 1
+            query.append(time.perf_counter() - started)
+        session.close()
+    finally:
+        simulator.stop()
+    return {
+        "find_state": summarize(find_state),
+        "send_sensors_round_trip": summarize(query),
+        "send_sensors_missed": missed,
+    }
+
+
+def bench_recorder(seconds: float) -> dict:
+    simulator = RoombaSimulator().start()
+    try:
+        session = RoombaSession(simulator.port)
+        stream = session.open_stream((43, 44, 20, 45, 9, 10, 11, 12, 7))
+        session.start()
+        stream.drain()
+        started = time.perf_counter()
+        frames = 0
+        while time.perf_counter() - started < seconds:
+            time.sleep(0.1)
+            frames += len(stream.drain())
+        frames_per_second = frames / (time.perf_counter() - started)
+        skipped_bytes = stream.parser.skipped_bytes
+        session.close()
+    finally:
+        simulator.stop()
+
+    directory = tempfile.mkdtemp()
+    try:
+        sample = {
+            "encoder_delta": 12,
+            "degrees_turned": -3,
+            "light_bumper": False,
+            "cliff": False,
+            "bumper_wheel_drop": True,
+        }
+        count = 0
+        with MovementLog(os.path.join(directory, "movement")) as log:
+            started = time.perf_counter()
+            while time.perf_counter() - started < seconds:
+                for _ in range(100):
+                    log.append(sample)
+                count += 100
+            appends_per_second = count / (time.perf_counter() - started)
+    finally:
+        shutil.rmtree(directory)
+    return {
+        "stream_frames_per_second": frames_per_second,
+        "stream_skipped_bytes": skipped_bytes,
+        "log_appends_per_second": appends_per_second,
+    }
+
+
+def _write_logs(directory: str, size: int):
+    samples = [
+        {
+            "encoder_delta": (index * 7) % 40 - 5,
+            "degrees_turned": (index * 13) % 11 - 5,
+            "light_bumper": index % 97 == 0,
+            "cliff": index % 211 == 0,
+            "bumper_wheel_drop": index % 53 == 0,
+        }
+        for index in range(size)
+    ]
+    with open(os.path.join(directory, "movement.json"), "w") as f:
+        ujson.dump(samples, f)
+    with MovementLog(os.path.join(directory, "movement"), flush_every=size + 1) as log:
+        for sample in samples:
+            log.append(sample)
+    with MovementWriter(os.path.join(directory, "movement.fmov")) as writer:
+        for sample in samples:
+            writer.append(sample)
+
+
+def bench_visualize(sizes: list) -> dict:
+    import visualize_movement
+
+    results = {}
+    for size in sizes:
+        directory = tempfile.mkdtemp()
+        try:
+            _write_logs(directory, size)
+            result = {}
+            for name in ("movement.json", "movement", "movement.fmov"):
+                started = time.perf_counter()
+                movement = visualize_movement.load_movement(os.path.join(directory, name))
+                loaded = time.perf_counter()
+                _heading, x, y = visualize_movement.integrate_path(movement)
+                events = visualize_movement.find_events(movement)
+                integrated = time.perf_counter()
+                visualize_movement.render_svg(os.path.join(directory, "path.svg"), x, y, events)
+                rendered = time.perf_counter()
+                result[name] = {
+                    "load_ms": (loaded - started) * 1000,
+                    "integrate_ms": (integrated - loaded) * 1000,
+                    "render_svg_ms": (rendered - integrated) * 1000,
+                }
+            results[str(size)] = result
+        finally:
+            shutil.rmtree(directory)
+    return results
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bridge against simulator.py")
+    parser.add_argument("-o", "--output", default="bench_results.json")
+    parser.add_argument("--quick", action="store_true", help="fewer iterations and smaller logs")
+    args = parser.parse_args()
+
+    iterations = 20 if args.quick else 200
+    seconds = 1 if args.quick else 5
+    sizes = [1_000, 10_000] if args.quick else [1_000, 10_000, 100_000, 1_000_000]
+
+    results = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+    }
+    print("Command latency...")
+    results["command_latency"] = bench_command_latency(iterations)
+    print("find_state...")
+    results["find_state"] = bench_find_state(iterations)
+    print("Recorder...")
+    results["recorder"] = bench_recorder(seconds)
+    print("Visualize...")
+    results["visualize"] = bench_visualize(sizes)
+
+    with open(args.output, "w") as f:
+        ujson.dump(results, f, indent=2)
+    print(ujson.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+A command queue that MQTT's thread can put into, and the event loop can wait on.
+
+Commands that haven't started yet get coalesced:
+
+- A command that's already waiting is dropped as a duplicate
+- Only the newest of start/pause/return_to_base/clean_spot counts, since each one undoes the others
+- Urgent commands (pause, return_to_base) jump ahead of normal ones, and locate goes last
+- When the queue's full, a new command only gets in if it's more urgent than something waiting
+- Anything that isn't a command (not in PRIORITIES) never gets in, so it can't take a slot
+"""
+import asyncio
+import threading
+
+URGENT = 0
+NORMAL = 1
+LOW = 2
+PRIORITIES = {
+    "pause": URGENT,
+    "return_to_base": URGENT,
+    "start": NORMAL,
+    "clean_spot": NORMAL,
+    "locate": LOW,
+}
+SUPERSEDING = frozenset(("start", "pause", "return_to_base", "clean_spot"))
+"""Commands that replace each other, so only the newest one needs to run"""
+
+
+class CommandQueue:
+    """A bounded queue of (command, time it was received), most urgent first"""
+
+    def __init__(self, maxsize: int = 16):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.items = []
+        self.order = 0
+        self.loop = None
+        self.ready = None
+        self.duplicates = 0
+        self.superseded = 0
+        self.rejected = 0
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """Set up waking up get() on this event loop"""
+        self.loop = loop
+        self.ready = asyncio.Event()
+
+    def qsize(self) -> int:
+        return len(self.items)
+
+    def put(self, command: str, received_at: float) -> bool:
+        """Add a command (from any thread), and return whether it got in"""
+        priority = PRIORITIES.get(command)
+        with self.lock:
+            if priority is None:
+                self.rejected += 1
+                return False
+            if any(queued == command for _priority, _order, queued, _at in self.items):
+                self.duplicates += 1
+                return False
+            if command in SUPERSEDING:
+                kept = [item for item in self.items if item[2] not in SUPERSEDING]
+                self.superseded += len(self.items) - len(kept)
+                self.items = kept
+            if len(self.items) >= self.maxsize:
+                worst = max(self.items)
+                if worst[0] <= priority:
+                    self.rejected += 1
+                    return False
+                self.items.remove(worst)
+                self.rejected += 1
+            self.order += 1
+            self.items.append((priority, self.order, command, received_at))
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.ready.set)
+        return True
+
+    def get_nowait(self):
+        """Take the most urgent (then oldest) command, or None if there aren't any"""
+        with self.lock:
+            if not self.items:
+                return None
+            item = min(self.items)
+            self.items.remove(item)
+        return item[2], item[3]
+
+    async def get(self):
+        """Wait for a command, and take it"""
+        while True:
+            item = self.get_nowait()
+            if item is not None:
+                return item
+            # put() sets it from the event loop, so nothing can get in between here and the wait
+            self.ready.clear()
+            await self.ready.wait()
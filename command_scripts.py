@@ -0,0 +1,63 @@
+"""
+Run commands as scripts of writes and waits, in the background.
+
+A script is a sequence of steps:
+
+- bytes get written to the roomba
+- numbers are how many seconds to wait before the next step
+
+Waiting happens on the event loop, so polling, publishing, and other commands keep going while a
+script (like playing a song) runs, and a new command can cancel a script partway through. Cancelling
+one before its first step would mean it never did anything, so wait_started() should be awaited
+before taking the next command.
+"""
+import asyncio
+
+
+class ScriptRunner:
+    """Run one script at a time, in the background"""
+
+    def __init__(self, write, log=print):
+        self.write = write
+        """Coroutine function that writes bytes to the roomba"""
+        self.log = log
+        self.task = None
+        self.name = None
+        self.started = None
+        """Set once the running script has done its first step (or stopped)"""
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def run(self, name: str, steps) -> asyncio.Task:
+        """Start running a script, cancelling whatever was running before"""
+        self.cancel()
+        self.name = name
+        self.started = asyncio.Event()
+        self.task = asyncio.create_task(self._run(name, tuple(steps), self.started))
+        return self.task
+
+    async def wait_started(self):
+        """Wait until the script that was run last has done its first step"""
+        if self.started is not None:
+            await self.started.wait()
+
+    def cancel(self):
+        """Stop the running script where it is (if there is one)"""
+        if self.running:
+            self.log("Cancelling", self.name)
+            self.task.cancel()
+
+    async def _run(self, name: str, steps, started: asyncio.Event):
+        try:
+            for step in steps:
+                if isinstance(step, (bytes, bytearray)):
+                    await self.write(step)
+                else:
+                    await asyncio.sleep(step)
+                started.set()
+        finally:
+            started.set()
+        if self.name == name:
+            self.name = None
@@ -0,0 +1,162 @@
+"""
+Build the bytes for commands to the Roomba, using the opcodes from interface.py.
+
+Commands with fixed arguments get cached, so they're only encoded once.
+build_script() turns a list of commands into a script for command_scripts.py, merging commands into
+as few writes as possible, and only waiting where the OI needs it (after mode changes).
+"""
+import struct
+from functools import lru_cache
+
+from interface import (
+    OPCODE_CLEAN,
+    OPCODE_DOCK,
+    OPCODE_DRIVE,
+    OPCODE_DRIVE_DIRECT,
+    OPCODE_DRIVE_PWM,
+    OPCODE_FULL,
+    OPCODE_LEDS,
+    OPCODE_PLAY_SONG,
+    OPCODE_POWER,
+    OPCODE_RESET,
+    OPCODE_SAFE,
+    OPCODE_SPOT,
+    OPCODE_START,
+    OPCODE_STOP,
+    OPCODE_STORE_SONG,
+)
+
+MODE_CHANGE_GAP = 0.02
+"""How long to wait after a command that changes the mode, before sending another one"""
+MODE_CHANGE_OPCODES = frozenset(
+    opcode[0]
+    for opcode in (
+        OPCODE_START,
+        OPCODE_SAFE,
+        OPCODE_FULL,
+        OPCODE_CLEAN,
+        OPCODE_SPOT,
+        OPCODE_DOCK,
+        OPCODE_POWER,
+        OPCODE_STOP,
+        OPCODE_RESET,
+    )
+)
+
+STRAIGHT = 32767
+"""Radius for driving straight"""
+TURN_CLOCKWISE = -1
+"""Radius for turning in place clockwise"""
+TURN_COUNTER_CLOCKWISE = 1
+"""Radius for turning in place counter-clockwise"""
+
+_TWO_SIGNED = struct.Struct(">Bhh")
+
+
+def _check(name: str, value: int, low: int, high: int):
+    if not low <= value <= high:
+        raise ValueError(f"{name} has to be between {low} and {high}, not {value}")
+
+
+@lru_cache(maxsize=256)
+def drive(velocity: int, radius: int = STRAIGHT) -> bytes:
+    """Drive at velocity mm/s (-500-500) around a circle with a radius in mm (-2000-2000)"""
+    _check("Velocity", velocity, -500, 500)
+    if radius not in (STRAIGHT, -32768):
+        _check("Radius", radius, -2000, 2000)
+    return _TWO_SIGNED.pack(OPCODE_DRIVE[0], velocity, radius)
+
+
+@lru_cache(maxsize=256)
+def drive_direct(left: int, right: int) -> bytes:
+    """Drive each wheel at a speed in mm/s (-500-500)"""
+    _check("Left velocity", left, -500, 500)
+    _check("Right velocity", right, -500, 500)
+    # The right wheel comes first
+    return _TWO_SIGNED.pack(OPCODE_DRIVE_DIRECT[0], right, left)
+
+
+@lru_cache(maxsize=256)
+def drive_pwm(left: int, right: int) -> bytes:
+    """Drive each wheel with some amount of power (-255-255)"""
+    _check("Left PWM", left, -255, 255)
+    _check("Right PWM", right, -255, 255)
+    # The right wheel comes first
+    return _TWO_SIGNED.pack(OPCODE_DRIVE_PWM[0], right, left)
+
+
+@lru_cache(maxsize=64)
+def leds(
+    debris: bool = False,
+    spot: bool = False,
+    dock: bool = False,
+    check_robot: bool = False,
+    power_color: int = 0,
+    power_intensity: int = 0,
+) -> bytes:
+    """Set the LEDs (the power LED goes from green at color 0 to red at color 255)"""
+    _check("Power color", power_color, 0, 255)
+    _check("Power intensity", power_intensity, 0, 255)
+    bits = (debris << 0) | (spot << 1) | (dock << 2) | (check_robot << 3)
+    return OPCODE_LEDS + bytes([bits, power_color, power_intensity])
+
+
+@lru_cache(maxsize=16)
+def store_song(number: int, notes: tuple) -> bytes:
+    """Store a song, from (note, length in 64ths of a second) pairs (note 0 is a rest)"""
+    _check("Song number", number, 0, 3)
+    _check("Note count", len(notes), 1, 16)
+    song = bytearray(OPCODE_STORE_SONG + bytes([number, len(notes)]))
+    for note, length in notes:
+        if note != 0:
+            _check("Note", note, 31, 127)
+        _check("Note length", length, 0, 255)
+        song += bytes([note, length])
+    return bytes(song)
+
+
+@lru_cache(maxsize=4)
+def play_song(number: int) -> bytes:
+    """Play a song that was stored"""
+    _check("Song number", number, 0, 3)
+    return OPCODE_PLAY_SONG + bytes([number])
+
+
+def song_length(notes) -> float:
+    """How long a song takes to play, in seconds"""
+    return sum(length for _note, length in notes) / 64
+
+
+def build_script(*steps) -> tuple:
+    """
+    Turn commands (bytes) and waits (seconds) into a script with as few writes as possible.
+
+    Commands next to each other get merged into one write, unless there's a mode change.
+    A command that changes the mode always starts its own write (so the session can see the mode
+    it's changing to), and is followed by a short wait before the next command.
+    """
+    script = []
+    pending = bytearray()
+    wait = 0
+    gap = 0
+    for step in steps:
+        if not isinstance(step, (bytes, bytearray)):
+            wait += step
+            continue
+        if not step:
+            continue
+        if max(wait, gap) > 0 or step[0] in MODE_CHANGE_OPCODES:
+            if pending:
+                script.append(bytes(pending))
+                pending.clear()
+            if max(wait, gap) > 0:
+                script.append(max(wait, gap))
+            wait = gap = 0
+        pending += step
+        if step[0] in MODE_CHANGE_OPCODES:
+            gap = MODE_CHANGE_GAP
+    if pending:
+        script.append(bytes(pending))
+    if wait > 0:
+        script.append(wait)
+    return tuple(script)
@@ -0,0 +1,114 @@
+"""
+Connect more than one roomba to Home Assistant, over one MQTT connection.
+
+Each roomba gets its own topics (roomba/<name>/command, roomba/<name>/state, roomba/<name>/metrics)
+and its own thread for its serial port, so one that's slow to answer or needs waking up doesn't hold
+up the others. They're listed in a JSON file like this:
+
+{
+  "mqtt_host": "homeassistant.local",
+  "robots": [
+    {"name": "downstairs", "port": "/dev/ttyUSB0"},
+    {"name": "upstairs", "port": "/dev/ttyUSB1", "poll_intervals": {"docked": 120}}
+  ]
+}
+
+A robot can have "broker": "/tmp/fiomba-serial.sock" instead of a port, to go through
+serial_broker.py (so record_movement.py can use it at the same time).
+
+python3 fleet.py fleet.json
+"""
+import argparse
+import asyncio
+import time
+import traceback
+
+import paho.mqtt.client as mqtt
+import ujson
+
+from polling import DEFAULT_INTERVALS, PollSchedule
+from profiling import Profiler, setup_profiling
+from serial_broker import BrokerSession
+from sd_notify import notify
+from server import MQTT_HOST, MQTT_PASSWORD, MQTT_USERNAME, STARTED, Bridge, start_mqtt
+from session import RoombaSession
+
+
+def load_config(path: str) -> dict:
+    """Load and check a fleet config file"""
+    with open(path) as f:
+        config = ujson.load(f)
+    robots = config.get("robots")
+    if not robots:
+        raise ValueError(f"{path} doesn't list any robots")
+    names = set()
+    for robot in robots:
+        if "name" not in robot or ("port" not in robot and "broker" not in robot):
+            raise ValueError(f"Each robot needs a name and a port (or broker), not {robot}")
+        if robot["name"] in names:
+            raise ValueError(f"There's more than one robot called {robot['name']}")
+        names.add(robot["name"])
+        for state in robot.get("poll_intervals", {}):
+            if state not in DEFAULT_INTERVALS:
+                raise ValueError(f"{state} isn't one of {list(DEFAULT_INTERVALS)}")
+    return config
+
+
+def make_bridge(robot: dict, ha: mqtt.Client, profiler: Profiler = None) -> Bridge:
+    """Set up a robot's bridge (it connects to the robot once it's running)"""
+    poll_schedule = PollSchedule(
+        robot.get("poll_intervals"),
+        robot.get("min_poll_interval", 0.5),
+        robot.get("max_poll_interval", 300),
+    )
+    if "broker" in robot:
+        session = BrokerSession(robot["broker"], connect=False)
+    else:
+        session = RoombaSession(robot["port"], connect=False)
+    return Bridge(
+        session,
+        ha,
+        poll_schedule,
+        topic=f"roomba/{robot['name']}",
+        name=robot["name"],
+        profiler=profiler,
+    )
+
+
+async def run_bridge(bridge: Bridge):
+    """Run one robot's bridge, without taking the others down if it breaks"""
+    try:
+        await bridge.run()
+    except Exception:
+        bridge.log("Stopped:")
+        traceback.print_exc()
+
+
+async def run_fleet(bridges: list):
+    tasks = [asyncio.create_task(run_bridge(bridge)) for bridge in bridges]
+    await asyncio.sleep(0)
+    notify("READY=1", f"STATUS=Bridging {len(bridges)} roombas")
+    print(f"Ready after {(time.perf_counter() - STARTED) * 1000:.0f}ms")
+    await asyncio.gather(*tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Connect several roombas to Home Assistant")
+    parser.add_argument("config", help="JSON file listing the robots")
+    parser.add_argument("--profile", metavar="DIRECTORY", help="profile to this directory")
+    args = parser.parse_args()
+    profiler = setup_profiling(args.profile)
+    config = load_config(args.config)
+
+    ha = mqtt.Client(config.get("client_id", "roomba-fleet"))
+    ha.username_pw_set(
+        config.get("mqtt_username", MQTT_USERNAME), config.get("mqtt_password", MQTT_PASSWORD)
+    )
+    bridges = [make_bridge(robot, ha, profiler) for robot in config["robots"]]
+    start_mqtt(ha, config.get("mqtt_host", MQTT_HOST), bridges)
+    print("*ahem*")
+    asyncio.run(run_fleet(bridges))
+
+
+if __name__ == "__main__":
+    main()
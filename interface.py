@@ -1,6 +1,11 @@
 """
-Opcodes for the iRobot Create 2.
+Opcodes and sensor packets for the iRobot Create 2.
 """
+import math
+import struct
+from collections import namedtuple
+from functools import lru_cache
+from typing import NamedTuple
 
 # from typing import Annotated
 # Opcode = Annotated[bytes, "Opcode in bytes"]
@@ -289,3 +294,168 @@ Format: [150, operation (0-off, 1-on)]
 Available: if the OI is connected.
 Mode change: Doesn't change mode.
 """
+
+
+STREAM_HEADER: int = 19
+"""
+The first byte of every frame the robot sends while streaming sensors.
+
+Frame format: [19, byte count, packet ID 1, packet 1 data, packet ID 2, packet 2 data, etc., checksum]
+The byte count doesn't include the header, itself, or the checksum.
+The checksum makes the low byte of the sum of every byte in the frame 0.
+"""
+
+
+class SensorPacket(NamedTuple):
+    """What a sensor packet looks like on the wire"""
+
+    name: str
+    size: int
+    signed: bool
+    scale: float = 1
+    """Multiply the raw value by this to get the value in normal units"""
+
+
+SENSOR_PACKETS: dict = {
+    7: SensorPacket("bumps_wheel_drops", 1, False),
+    8: SensorPacket("wall", 1, False),
+    9: SensorPacket("cliff_left", 1, False),
+    10: SensorPacket("cliff_front_left", 1, False),
+    11: SensorPacket("cliff_front_right", 1, False),
+    12: SensorPacket("cliff_right", 1, False),
+    13: SensorPacket("virtual_wall", 1, False),
+    14: SensorPacket("wheel_overcurrents", 1, False),
+    15: SensorPacket("dirt_detect", 1, False),
+    16: SensorPacket("unused_16", 1, False),
+    17: SensorPacket("infrared_omni", 1, False),
+    18: SensorPacket("buttons", 1, False),
+    19: SensorPacket("distance", 2, True),  # mm
+    20: SensorPacket("angle", 2, True),  # Degrees, left is positive
+    21: SensorPacket("charging_state", 1, False),
+    22: SensorPacket("voltage", 2, False, 0.001),  # V
+    23: SensorPacket("current", 2, True, 0.001),  # A
+    24: SensorPacket("temperature", 1, True),  # °C
+    25: SensorPacket("battery_charge", 2, False),  # mAh
+    26: SensorPacket("battery_capacity", 2, False),  # mAh
+    27: SensorPacket("wall_signal", 2, False),
+    28: SensorPacket("cliff_left_signal", 2, False),
+    29: SensorPacket("cliff_front_left_signal", 2, False),
+    30: SensorPacket("cliff_front_right_signal", 2, False),
+    31: SensorPacket("cliff_right_signal", 2, False),
+    32: SensorPacket("unused_32", 1, False),
+    33: SensorPacket("unused_33", 2, False),
+    34: SensorPacket("charging_sources", 1, False),
+    35: SensorPacket("oi_mode", 1, False),
+    36: SensorPacket("song_number", 1, False),
+    37: SensorPacket("song_playing", 1, False),
+    38: SensorPacket("stream_packet_count", 1, False),
+    39: SensorPacket("requested_velocity", 2, True),  # mm/s
+    40: SensorPacket("requested_radius", 2, True),  # mm
+    41: SensorPacket("requested_right_velocity", 2, True),  # mm/s
+    42: SensorPacket("requested_left_velocity", 2, True),  # mm/s
+    43: SensorPacket("left_encoder", 2, False),  # Counts, wraps around
+    44: SensorPacket("right_encoder", 2, False),  # Counts, wraps around
+    45: SensorPacket("light_bumper", 1, False),
+    46: SensorPacket("light_bump_left_signal", 2, False),
+    47: SensorPacket("light_bump_front_left_signal", 2, False),
+    48: SensorPacket("light_bump_center_left_signal", 2, False),
+    49: SensorPacket("light_bump_center_right_signal", 2, False),
+    50: SensorPacket("light_bump_front_right_signal", 2, False),
+    51: SensorPacket("light_bump_right_signal", 2, False),
+    52: SensorPacket("infrared_left", 1, False),
+    53: SensorPacket("infrared_right", 1, False),
+    54: SensorPacket("left_motor_current", 2, True, 0.001),  # A
+    55: SensorPacket("right_motor_current", 2, True, 0.001),  # A
+    56: SensorPacket("main_brush_current", 2, True, 0.001),  # A
+    57: SensorPacket("side_brush_current", 2, True, 0.001),  # A
+    58: SensorPacket("stasis", 1, False),
+}
+"""
+Every single sensor packet, by packet ID (check [the sensor packet docs](https://www.irobot.com/~/media/mainsite/pdfs/about/stem/create/create_2_open_interface_spec.pdf#page=22)).
+Everything is big endian.
+"""
+MM_PER_COUNT = math.pi * 72 / 508.8
+"""How far a wheel goes for each count of the encoders (packets 43 and 44): 72mm wheels, 508.8
+counts a turn"""
+
+
+class SensorLayout:
+    """How to ask for, and decode, a specific list of sensor packets"""
+
+    def __init__(self, packet_ids: tuple):
+        for packet_id in packet_ids:
+            if packet_id not in SENSOR_PACKETS:
+                raise ValueError(f"Unknown sensor packet {packet_id}")
+        self.packet_ids = packet_ids
+        self.packets = tuple(SENSOR_PACKETS[packet_id] for packet_id in packet_ids)
+        self.names = tuple(packet.name for packet in self.packets)
+        self.Record = namedtuple("SensorRecord", self.names)
+        self.scales = tuple(packet.scale for packet in self.packets)
+        self.needs_scaling = any(scale != 1 for scale in self.scales)
+        # A SEND_SENSORS reply is just the data, one packet after another
+        self.struct = struct.Struct(">" + "".join(_format(packet) for packet in self.packets))
+        self.size = self.struct.size
+        self.request = OPCODE_SEND_SENSORS + bytes([len(packet_ids), *packet_ids])
+        # A stream frame has the header, byte count, and checksum, and an ID before each packet
+        self.frame_struct = struct.Struct(
+            ">BB" + "".join("B" + _format(packet) for packet in self.packets) + "B"
+        )
+        self.frame_size = self.frame_struct.size
+        self.frame_byte_count = self.frame_size - 3
+        self.stream_request = OPCODE_STREAM_SENSORS + bytes([len(packet_ids), *packet_ids])
+
+    def _record(self, values):
+        if self.needs_scaling:
+            values = [value * scale for value, scale in zip(values, self.scales)]
+        return self.Record._make(values)
+
+    def decode(self, data: bytes):
+        """Decode a SEND_SENSORS reply"""
+        return self._record(self.struct.unpack(data))
+
+    def decode_frame(self, frame: bytes):
+        """Decode a stream frame, or return None if the packet IDs in it are wrong"""
+        fields = self.frame_struct.unpack(frame)
+        if fields[2:-1:2] != self.packet_ids:
+            return None
+        return self._record(fields[3:-1:2])
+
+    def read(self, roomba):
+        """Read a whole SEND_SENSORS reply at once, or return None if it didn't all come"""
+        data = roomba.read(self.size)
+        if len(data) < self.size:
+            return None
+        return self.decode(data)
+
+    def query(self, roomba):
+        """Ask for the packets, and read the reply"""
+        roomba.write(self.request)
+        return self.read(roomba)
+
+    def decode_batch(self, data: bytes) -> dict:
+        """Decode a lot of SEND_SENSORS replies back to back into a NumPy array for each packet"""
+        import numpy as np  # Only needed for analysis, so it doesn't slow down the server
+
+        dtype = np.dtype(
+            [
+                (packet.name, (">i" if packet.signed else ">u") + str(packet.size))
+                for packet in self.packets
+            ]
+        )
+        rows = np.frombuffer(data, dtype, count=len(data) // self.size)
+        columns = {}
+        for packet in self.packets:
+            column = rows[packet.name].astype(np.int32)
+            columns[packet.name] = column * packet.scale if packet.scale != 1 else column
+        return columns
+
+
+def _format(packet: SensorPacket) -> str:
+    code = "b" if packet.size == 1 else "h"
+    return code if packet.signed else code.upper()
+
+
+@lru_cache(maxsize=None)
+def sensor_layout(packet_ids) -> SensorLayout:
+    """Get the (cached) layout for a tuple of sensor packet IDs"""
+    return SensorLayout(tuple(packet_ids))
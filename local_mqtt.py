@@ -0,0 +1,174 @@
+"""
+A tiny in-process stand-in for an MQTT broker, with a client that works like paho's.
+
+Messages are delivered on a background thread (like paho's network thread), so code written for
+paho.mqtt.client.Client can run against it without a real broker, for tests and benchmarks.
+"""
+import queue
+import threading
+import time
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """Check if a topic matches a subscription (with + and # wildcards)"""
+    filter_parts = topic_filter.split("/")
+    topic_parts = topic.split("/")
+    for index, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if index >= len(topic_parts):
+            return False
+        if part != "+" and part != topic_parts[index]:
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+class MQTTMessage:
+    """A message, with the same fields as paho's"""
+
+    def __init__(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.timestamp = time.monotonic()
+
+
+class MessageInfo:
+    """What publish() returns, like paho's"""
+
+    rc = 0
+    mid = 0
+
+    def wait_for_publish(self, timeout: float = None):
+        pass
+
+    def is_published(self) -> bool:
+        return True
+
+
+class LocalBroker:
+    """Pass messages between clients in the same process"""
+
+    def __init__(self):
+        self.clients = []
+        self.retained = {}
+        self.lock = threading.Lock()
+        self.deliveries = queue.Queue()
+        self.published = 0
+        self._thread = threading.Thread(target=self._deliver, daemon=True)
+        self._thread.start()
+
+    def Client(self, client_id: str = "", **_kwargs) -> "Client":
+        """Make a client that's connected to this broker"""
+        return Client(client_id, broker=self)
+
+    def publish(self, topic: str, payload, qos: int = 0, retain: bool = False):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif payload is None:
+            payload = b""
+        message = MQTTMessage(topic, payload, qos, retain)
+        with self.lock:
+            self.published += 1
+            if retain:
+                self.retained[topic] = message
+            clients = list(self.clients)
+        for client in clients:
+            if client.is_subscribed(topic):
+                self.deliveries.put((client, message))
+
+    def _deliver(self):
+        while True:
+            client, message = self.deliveries.get()
+            client.handle_message(message)
+
+    def wait_until_delivered(self, timeout: float = 5):
+        """Wait for every message so far to get to its subscribers"""
+        deadline = time.monotonic() + timeout
+        while not self.deliveries.empty() and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+
+class Client:
+    """The parts of paho.mqtt.client.Client that the bridge uses"""
+
+    def __init__(self, client_id: str = "", broker: LocalBroker = None):
+        self.client_id = client_id
+        self.broker = broker if broker is not None else LocalBroker()
+        self.subscriptions = set()
+        self.callbacks = []
+        self.on_message = None
+        self.on_connect = None
+        self.on_disconnect = None
+        self.connected = False
+
+    def username_pw_set(self, username: str, password: str = None):
+        pass
+
+    def connect(self, host: str = "localhost", port: int = 1883, keepalive: int = 60):
+        with self.broker.lock:
+            if self not in self.broker.clients:
+                self.broker.clients.append(self)
+        self.connected = True
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+        return 0
+
+    def connect_async(self, host: str = "localhost", port: int = 1883, keepalive: int = 60):
+        return self.connect(host, port, keepalive)
+
+    def reconnect(self):
+        return self.connect()
+
+    def disconnect(self):
+        with self.broker.lock:
+            if self in self.broker.clients:
+                self.broker.clients.remove(self)
+        self.connected = False
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, 0)
+        return 0
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def subscribe(self, topic: str, qos: int = 0):
+        self.subscriptions.add(topic)
+        for retained_topic, message in list(self.broker.retained.items()):
+            if topic_matches(topic, retained_topic):
+                self.broker.deliveries.put((self, message))
+        return (0, 0)
+
+    def unsubscribe(self, topic: str):
+        self.subscriptions.discard(topic)
+        return (0, 0)
+
+    def message_callback_add(self, topic_filter: str, callback):
+        self.callbacks.append((topic_filter, callback))
+
+    def is_subscribed(self, topic: str) -> bool:
+        return any(topic_matches(topic_filter, topic) for topic_filter in self.subscriptions)
+
+    def handle_message(self, message: MQTTMessage):
+        handled = False
+        for topic_filter, callback in list(self.callbacks):
+            if topic_matches(topic_filter, message.topic):
+                callback(self, None, message)
+                handled = True
+        if not handled and self.on_message is not None:
+            self.on_message(self, None, message)
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        if not self.connected:
+            info = MessageInfo()
+            info.rc = 4  # MQTT_ERR_NO_CONN
+            return info
+        self.broker.publish(topic, payload, qos, retain)
+        return MessageInfo()
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
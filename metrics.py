@@ -0,0 +1,101 @@
+"""
+Keep track of how the bridge is doing, cheaply enough to leave on all the time.
+
+Times go into histograms with fixed buckets, so recording one is a binary search and an increment,
+and memory use doesn't grow. snapshot() flattens everything into one level of JSON, so each value
+can be its own Home Assistant sensor, like this:
+
+mqtt:
+  sensor:
+    - name: Roomba command wait
+      state_topic: roomba/metrics
+      unit_of_measurement: ms
+      value_template: "{{ value_json.command_wait_ms_p95 }}"
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+"""The upper bound of each bucket, in milliseconds (anything bigger goes in one more bucket)"""
+
+
+class Histogram:
+    """Count how many values fall into each bucket"""
+
+    def __init__(self, bounds=BUCKETS_MS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction: float) -> float:
+        """Roughly what value this fraction of them are under (the top of the bucket it's in)"""
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+        return self.max
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class Metrics:
+    """Counters, gauges, and histograms, by name"""
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name: str, amount: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def observe(self, name: str, milliseconds: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(milliseconds)
+
+    @contextmanager
+    def time(self, name: str):
+        """Time the code in a with block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - started) * 1000)
+
+    def snapshot(self, reset: bool = True) -> dict:
+        """Flatten everything into one dict, and start the histograms over if reset is set"""
+        snapshot = dict(self.counters)
+        snapshot.update(self.gauges)
+        for name, histogram in self.histograms.items():
+            snapshot[f"{name}_count"] = histogram.count
+            if histogram.count:
+                snapshot[f"{name}_mean"] = round(histogram.total / histogram.count, 3)
+                snapshot[f"{name}_p50"] = histogram.percentile(0.5)
+                snapshot[f"{name}_p95"] = histogram.percentile(0.95)
+                snapshot[f"{name}_max"] = round(histogram.max, 3)
+            if reset:
+                histogram.reset()
+        return snapshot
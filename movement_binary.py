@@ -0,0 +1,243 @@
+"""
+A compact binary format for the Roomba's movement, for analyzing long recordings.
+
+The file starts with a 16 byte header:
+
+- Magic (b"FMOV")
+- Version (uint16, little endian)
+- Record size (uint16, little endian)
+- Reserved (8 bytes of 0)
+
+Then there's one 17 byte record per sample, all little endian:
+
+- encoder_delta (int32)
+- degrees_turned (int16)
+- Flags (uint8, bit 0 is light_bumper, bit 1 is cliff, bit 2 is bumper_wheel_drop)
+- left_delta (int32)
+- right_delta (int32)
+- duration (uint16, milliseconds)
+
+Version 1 files only have the first three (7 bytes), and are still read (and appended to). Their
+samples are all DEFAULT_DURATION long, and the wheels don't have their own deltas. Samples from
+before the wheels were kept separate are split evenly between them when written to version 2.
+
+The reader memory-maps the file, so the columns are NumPy views of the file that don't need to be
+loaded into memory first.
+
+To convert a recording: python3 movement_binary.py movement movement.fmov
+(movement can be a movement_log.py directory or an old movement.json)
+"""
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+import ujson
+
+from movement_log import DEFAULT_DURATION, read_movement
+
+MAGIC = b"FMOV"
+VERSION = 2
+HEADER = struct.Struct("<4sHH8x")
+RECORDS = {
+    1: struct.Struct("<ihB"),
+    2: struct.Struct("<ihBiiH"),
+}
+"""The record in each version of the format"""
+RECORD = RECORDS[VERSION]
+RECORD_DTYPES = {
+    1: np.dtype([("encoder_delta", "<i4"), ("degrees_turned", "<i2"), ("flags", "u1")]),
+    2: np.dtype(
+        [
+            ("encoder_delta", "<i4"),
+            ("degrees_turned", "<i2"),
+            ("flags", "u1"),
+            ("left_delta", "<i4"),
+            ("right_delta", "<i4"),
+            ("duration_ms", "<u2"),
+        ]
+    ),
+}
+RECORD_DTYPE = RECORD_DTYPES[VERSION]
+
+LIGHT_BUMPER = 1
+CLIFF = 2
+BUMPER_WHEEL_DROP = 4
+
+
+def pack_sample(sample: dict, version: int = VERSION) -> bytes:
+    """Turn a sample into a record"""
+    flags = (
+        (LIGHT_BUMPER if sample["light_bumper"] else 0)
+        | (CLIFF if sample["cliff"] else 0)
+        | (BUMPER_WHEEL_DROP if sample["bumper_wheel_drop"] else 0)
+    )
+    if version == 1:
+        return RECORDS[1].pack(sample["encoder_delta"], sample["degrees_turned"], flags)
+    left_delta = sample.get("left_delta")
+    right_delta = sample.get("right_delta")
+    if left_delta is None or right_delta is None:
+        left_delta = sample["encoder_delta"] // 2
+        right_delta = sample["encoder_delta"] - left_delta
+    duration = round(sample.get("duration", DEFAULT_DURATION) * 1000)
+    return RECORD.pack(
+        sample["encoder_delta"],
+        sample["degrees_turned"],
+        flags,
+        left_delta,
+        right_delta,
+        min(duration, 0xFFFF),
+    )
+
+
+class MovementWriter:
+    """Append samples to a binary movement file"""
+
+    def __init__(self, path: str):
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        self.file = open(path, "r+b" if exists else "wb")
+        if exists:
+            # Keep adding to an older file in its own version
+            self.version = _check_header(self.file.read(HEADER.size), path)
+            record_size = RECORDS[self.version].size
+            # Drop any record that was only partly written
+            size = self.file.seek(0, os.SEEK_END)
+            whole_records = (size - HEADER.size) // record_size
+            self.file.truncate(HEADER.size + whole_records * record_size)
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.version = VERSION
+            self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+
+    def append(self, sample: dict):
+        """Add a sample to the end of the file"""
+        self.file.write(pack_sample(sample, self.version))
+
+    def flush(self):
+        """Write out everything appended so far"""
+        self.file.flush()
+
+    def close(self):
+        """Save everything and close the file"""
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+
+def _check_header(header: bytes, path: str) -> int:
+    """Check it's a movement file, and return its version"""
+    if len(header) < HEADER.size:
+        raise ValueError(f"{path} is too short to be a movement file")
+    magic, version, record_size = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError(f"{path} isn't a movement file")
+    if version not in RECORDS or record_size != RECORDS[version].size:
+        raise ValueError(f"{path} is version {version}, but only up to {VERSION} is supported")
+    return version
+
+
+class MovementFile:
+    """Read a binary movement file, without loading it into memory"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.version = _check_header(f.read(HEADER.size), path)
+            dtype = RECORD_DTYPES[self.version]
+            count = (os.fstat(f.fileno()).st_size - HEADER.size) // dtype.itemsize
+            if count > 0:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.records = np.frombuffer(self._mmap, dtype, count=count, offset=HEADER.size)
+            else:
+                self._mmap = None
+                self.records = np.zeros(0, dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def encoder_delta(self) -> np.ndarray:
+        """How far it moved in each sample (a view of the file)"""
+        return self.records["encoder_delta"]
+
+    @property
+    def degrees_turned(self) -> np.ndarray:
+        """How much it turned in each sample (a view of the file)"""
+        return self.records["degrees_turned"]
+
+    @property
+    def flags(self) -> np.ndarray:
+        """The packed flags of each sample (a view of the file)"""
+        return self.records["flags"]
+
+    @property
+    def left_delta(self) -> np.ndarray:
+        """How far the left wheel went in each sample, or None in a version 1 file"""
+        return self.records["left_delta"] if self.version >= 2 else None
+
+    @property
+    def right_delta(self) -> np.ndarray:
+        """How far the right wheel went in each sample, or None in a version 1 file"""
+        return self.records["right_delta"] if self.version >= 2 else None
+
+    @property
+    def duration(self) -> np.ndarray:
+        """How many seconds each sample covers"""
+        if self.version >= 2:
+            return self.records["duration_ms"] / 1000
+        return np.full(len(self.records), DEFAULT_DURATION)
+
+    @property
+    def light_bumper(self) -> np.ndarray:
+        return (self.flags & LIGHT_BUMPER) != 0
+
+    @property
+    def cliff(self) -> np.ndarray:
+        return (self.flags & CLIFF) != 0
+
+    @property
+    def bumper_wheel_drop(self) -> np.ndarray:
+        return (self.flags & BUMPER_WHEEL_DROP) != 0
+
+    def close(self):
+        """Let go of the memory map (the columns can't be used after this)"""
+        self.records = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Someone's still using a column, so it'll be closed when they're done with it
+                pass
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+
+def convert(source: str, path: str):
+    """Write a movement_log.py directory or an old movement.json to a binary movement file"""
+    if os.path.isdir(source):
+        samples = read_movement(source)
+    else:
+        with open(source) as f:
+            samples = ujson.load(f)
+    count = 0
+    with MovementWriter(path) as writer:
+        for sample in samples:
+            writer.append(sample)
+            count += 1
+    print("Converted", count, "samples")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 movement_binary.py movement movement.fmov")
+        sys.exit(1)
+    convert(sys.argv[1], sys.argv[2])
@@ -0,0 +1,153 @@
+"""
+Save the Roomba's movement as it's recorded, without rewriting everything that came before.
+
+Samples are written as JSON lines (one sample per line) to numbered segment files in a directory:
+
+movement/movement-000000.jsonl, movement/movement-000001.jsonl, etc.
+
+Every sample only gets appended, so saving one doesn't get slower as the recording gets longer.
+If the recorder crashes mid-write, only the last (partial) line is lost, and the reader skips it.
+A new segment is started for every recording, and when the current one gets too big or too old.
+
+To convert an old movement.json: python3 movement_log.py movement.json movement
+"""
+import os
+import sys
+import time
+
+import ujson
+
+SEGMENT_PREFIX = "movement-"
+SEGMENT_SUFFIX = ".jsonl"
+DEFAULT_DURATION = 0.5
+"""How many seconds a sample without a duration covers (record_movement.py used to sample every
+half a second)"""
+
+
+def segment_paths(directory: str) -> list:
+    """Find every segment in a directory, oldest first"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    segments = [
+        name
+        for name in names
+        if name.startswith(SEGMENT_PREFIX)
+        and name.endswith(SEGMENT_SUFFIX)
+        and name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)].isdigit()
+    ]
+    segments.sort(key=lambda name: int(name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)]))
+    return [os.path.join(directory, name) for name in segments]
+
+
+class MovementLog:
+    """Append movement samples to the segments in a directory"""
+
+    def __init__(
+        self,
+        directory: str = "movement",
+        flush_every: int = 20,
+        flush_interval: float = 1.0,
+        fsync_interval: float = 5.0,
+        max_segment_bytes: int = 4 * 1024 * 1024,
+        max_segment_age: float = 3600,
+    ):
+        self.directory = directory
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_age = max_segment_age
+        os.makedirs(directory, exist_ok=True)
+        existing = segment_paths(directory)
+        if existing:
+            last_name = os.path.basename(existing[-1])
+            self.segment_number = int(last_name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)]) + 1
+        else:
+            self.segment_number = 0
+        self.file = None
+        self._open_segment()
+
+    def _open_segment(self):
+        path = os.path.join(
+            self.directory, f"{SEGMENT_PREFIX}{self.segment_number:06d}{SEGMENT_SUFFIX}"
+        )
+        self.file = open(path, "a", encoding="utf-8")
+        self.segment_bytes = self.file.tell()
+        self.segment_started = time.monotonic()
+        self.unflushed = 0
+        self.last_flush = self.last_fsync = time.monotonic()
+
+    def _rotate(self):
+        self.flush(fsync=True)
+        self.file.close()
+        self.segment_number += 1
+        self._open_segment()
+
+    def append(self, sample: dict):
+        """Add a sample to the end of the log"""
+        line = ujson.dumps(sample) + "\n"
+        self.file.write(line)
+        self.segment_bytes += len(line)
+        self.unflushed += 1
+        now = time.monotonic()
+        if self.unflushed >= self.flush_every or now - self.last_flush > self.flush_interval:
+            self.flush(fsync=now - self.last_fsync > self.fsync_interval)
+        if (
+            self.segment_bytes >= self.max_segment_bytes
+            or now - self.segment_started > self.max_segment_age
+        ):
+            self._rotate()
+
+    def flush(self, fsync: bool = False):
+        """Write out everything appended so far, and make sure it's on disk if fsync is set"""
+        self.file.flush()
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+        if fsync:
+            os.fsync(self.file.fileno())
+            self.last_fsync = self.last_flush
+
+    def close(self):
+        """Save everything and close the current segment"""
+        if self.file is not None and not self.file.closed:
+            self.flush(fsync=True)
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+
+def read_movement(directory: str = "movement"):
+    """Go through every sample in every segment, in the order they were recorded"""
+    for path in segment_paths(directory):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # The recorder stopped in the middle of writing this one
+                    break
+                try:
+                    yield ujson.loads(line)
+                except ValueError:
+                    print("Skipping a broken sample in", path)
+
+
+def convert(json_path: str, directory: str):
+    """Move an old movement.json into a segment"""
+    with open(json_path) as f:
+        movement = ujson.load(f)
+    with MovementLog(directory, flush_every=len(movement) + 1, max_segment_age=float("inf")) as log:
+        for sample in movement:
+            log.append(sample)
+    print("Converted", len(movement), "samples")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 movement_log.py movement.json movement")
+        sys.exit(1)
+    convert(sys.argv[1], sys.argv[2])
@@ -0,0 +1,256 @@
+"""
+Build a map of where the Roomba has been, and what it bumped into, one sample at a time.
+
+The floor is split into 50mm cells, in 64x64 tiles that only exist once the Roomba gets near them,
+so a sample only touches the few cells around it no matter how long the run's been going. Each cell
+is a byte of flags:
+
+- 1: light bumper saw something there
+- 2: cliff there
+- 4: bumped into something there
+- 8: the Roomba has been over it
+
+(the first three are the same bits as movement_binary.py)
+
+Snapshots are zlib compressed (the header and the Roomba's position, then each tile's position and
+cells), so saving one is quick enough to do every few seconds during a run. render_png() makes an
+image for Home Assistant, with the local_file camera:
+
+camera:
+  - platform: local_file
+    name: Roomba coverage
+    file_path: /home/pi/2vFiomba/map.png
+
+To make one from a recording: python3 occupancy_map.py movement -o map.fmap --png map.png
+"""
+import argparse
+import math
+import os
+import struct
+import zlib
+
+from interface import MM_PER_COUNT
+
+LIGHT_BUMPER = 1
+CLIFF = 2
+BUMPER_WHEEL_DROP = 4
+SWEPT = 8
+
+CELL_SIZE = 50
+"""How big each cell is, in mm"""
+TILE_CELLS = 64
+"""How many cells wide and tall each tile is"""
+ROBOT_RADIUS = 170
+"""How far from the middle of the Roomba it cleans (and bumps into things), in mm"""
+MAX_STEPS = 64
+"""The most cells a single sample gets swept along (anything longer is probably a glitch)"""
+
+MAGIC = b"FMAP"
+VERSION = 1
+HEADER = struct.Struct("<4sHHHIfff")
+TILE_HEADER = struct.Struct("<ii")
+
+COLORS = (
+    # The most important flag in a cell decides its color
+    (BUMPER_WHEEL_DROP, (255, 102, 102)),
+    (CLIFF, (255, 102, 255)),
+    (LIGHT_BUMPER, (230, 230, 0)),
+    (SWEPT, (120, 170, 255)),
+)
+UNKNOWN_COLOR = (255, 255, 255)
+
+
+def _footprint(radius: float) -> tuple:
+    """The cells (relative to the middle one) that are within radius of the middle"""
+    cells = math.ceil(radius / CELL_SIZE)
+    return tuple(
+        (dx, dy)
+        for dy in range(-cells, cells + 1)
+        for dx in range(-cells, cells + 1)
+        if math.hypot(dx, dy) * CELL_SIZE <= radius
+    )
+
+
+class OccupancyMap:
+    """A sparse grid of what's been seen where, built up from movement samples"""
+
+    def __init__(self):
+        self.tiles = {}
+        """A bytearray of cells for each (tile x, tile y)"""
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        """Which way the Roomba is facing, in degrees (left is positive, like degrees_turned)"""
+        self.footprint = _footprint(ROBOT_RADIUS)
+        self._last_cell = None
+
+    def mark(self, cell_x: int, cell_y: int, flags: int):
+        """Set flags on a cell"""
+        tile_key = (cell_x // TILE_CELLS, cell_y // TILE_CELLS)
+        tile = self.tiles.get(tile_key)
+        if tile is None:
+            tile = self.tiles[tile_key] = bytearray(TILE_CELLS * TILE_CELLS)
+        tile[(cell_y % TILE_CELLS) * TILE_CELLS + cell_x % TILE_CELLS] |= flags
+
+    def get(self, cell_x: int, cell_y: int) -> int:
+        """Get a cell's flags"""
+        tile = self.tiles.get((cell_x // TILE_CELLS, cell_y // TILE_CELLS))
+        if tile is None:
+            return 0
+        return tile[(cell_y % TILE_CELLS) * TILE_CELLS + cell_x % TILE_CELLS]
+
+    def _sweep(self, x: float, y: float):
+        cell = (math.floor(x / CELL_SIZE), math.floor(y / CELL_SIZE))
+        if cell == self._last_cell:
+            return
+        self._last_cell = cell
+        cell_x, cell_y = cell
+        for dx, dy in self.footprint:
+            self.mark(cell_x + dx, cell_y + dy, SWEPT)
+
+    def update(self, sample: dict):
+        """Add a movement sample (it turns first, then moves, like visualize_movement.py)"""
+        self.heading += sample["degrees_turned"]
+        radians = math.radians(self.heading)
+        distance = sample["encoder_delta"] / 2 * MM_PER_COUNT
+        steps = min(MAX_STEPS, math.ceil(abs(distance) / CELL_SIZE))
+        start_x, start_y = self.x, self.y
+        self.x += distance * math.cos(radians)
+        self.y += distance * math.sin(radians)
+        if steps == 0:
+            self._sweep(self.x, self.y)
+        for step in range(1, steps + 1):
+            fraction = step / steps
+            self._sweep(
+                start_x + (self.x - start_x) * fraction, start_y + (self.y - start_y) * fraction
+            )
+
+        flags = (
+            (LIGHT_BUMPER if sample["light_bumper"] else 0)
+            | (CLIFF if sample["cliff"] else 0)
+            | (BUMPER_WHEEL_DROP if sample["bumper_wheel_drop"] else 0)
+        )
+        if flags:
+            # Whatever it was is just in front of the Roomba
+            reach = ROBOT_RADIUS + CELL_SIZE / 2
+            self.mark(
+                math.floor((self.x + reach * math.cos(radians)) / CELL_SIZE),
+                math.floor((self.y + reach * math.sin(radians)) / CELL_SIZE),
+                flags,
+            )
+
+    def coverage(self) -> float:
+        """How much floor has been swept, in square meters"""
+        swept = sum(sum(1 for cell in tile if cell & SWEPT) for tile in self.tiles.values())
+        return swept * CELL_SIZE * CELL_SIZE / 1_000_000
+
+    def snapshot(self, path: str):
+        """Save the map (safely, so a half written file never replaces the last one)"""
+        data = bytearray(
+            HEADER.pack(
+                MAGIC, VERSION, CELL_SIZE, TILE_CELLS, len(self.tiles), self.x, self.y, self.heading
+            )
+        )
+        for (tile_x, tile_y), tile in self.tiles.items():
+            data += TILE_HEADER.pack(tile_x, tile_y)
+            data += tile
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(zlib.compress(data, 1))
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        """Load a snapshot, to keep adding to it"""
+        with open(path, "rb") as f:
+            data = zlib.decompress(f.read())
+        magic, version, cell_size, tile_cells, tile_count, x, y, heading = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} isn't a version {VERSION} map")
+        if cell_size != CELL_SIZE or tile_cells != TILE_CELLS:
+            raise ValueError(f"{path} has {cell_size}mm cells in {tile_cells} cell tiles")
+        occupancy_map = cls()
+        occupancy_map.x, occupancy_map.y, occupancy_map.heading = x, y, heading
+        offset = HEADER.size
+        tile_size = TILE_CELLS * TILE_CELLS
+        for _ in range(tile_count):
+            tile_key = TILE_HEADER.unpack_from(data, offset)
+            offset += TILE_HEADER.size
+            occupancy_map.tiles[tile_key] = bytearray(data[offset : offset + tile_size])
+            offset += tile_size
+        return occupancy_map
+
+    def render_png(self, scale: int = 2) -> bytes:
+        """Draw the map as a PNG (each cell is scale pixels, and it started off facing right)"""
+        if not self.tiles:
+            return _png(1, 1, bytes(UNKNOWN_COLOR), b"\x00\x00")
+        tile_xs = [tile_x for tile_x, _tile_y in self.tiles]
+        tile_ys = [tile_y for _tile_x, tile_y in self.tiles]
+        min_tile_x, max_tile_x = min(tile_xs), max(tile_xs)
+        min_tile_y, max_tile_y = min(tile_ys), max(tile_ys)
+        blank = bytes(TILE_CELLS)
+        # Every cell's flags map straight to a palette entry
+        palette_indexes = bytearray(256)
+        for flags in range(256):
+            for index, (flag, _color) in enumerate(COLORS):
+                if flags & flag:
+                    palette_indexes[flags] = index + 1
+                    break
+        palette = bytes(UNKNOWN_COLOR) + b"".join(bytes(color) for _flag, color in COLORS)
+
+        rows = []
+        for tile_y in range(max_tile_y, min_tile_y - 1, -1):
+            for row in range(TILE_CELLS - 1, -1, -1):
+                cells = b"".join(
+                    (
+                        self.tiles[tile_x, tile_y][row * TILE_CELLS : (row + 1) * TILE_CELLS]
+                        if (tile_x, tile_y) in self.tiles
+                        else blank
+                    )
+                    for tile_x in range(min_tile_x, max_tile_x + 1)
+                ).translate(palette_indexes)
+                if scale > 1:
+                    cells = bytes(index for index in cells for _ in range(scale))
+                rows.extend([b"\x00" + cells] * scale)
+        width = (max_tile_x - min_tile_x + 1) * TILE_CELLS * scale
+        return _png(width, len(rows), palette, b"".join(rows))
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def _png(width: int, height: int, palette: bytes, rows: bytes) -> bytes:
+    """Make an 8 bit paletted PNG out of rows that each start with a filter byte"""
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0))
+        + _png_chunk(b"PLTE", palette)
+        + _png_chunk(b"IDAT", zlib.compress(rows))
+        + _png_chunk(b"IEND", b"")
+    )
+
+
+def main():
+    # Only needed for reading old logs, and it pulls in NumPy
+    from visualize_movement import COLUMNS, load_movement
+
+    parser = argparse.ArgumentParser(description="Build a coverage map from a movement log")
+    parser.add_argument("log", help="movement directory, .fmov file, or movement.json")
+    parser.add_argument("-o", "--output", default="map.fmap")
+    parser.add_argument("--png", help="also draw the map to this PNG")
+    args = parser.parse_args()
+
+    movement = load_movement(args.log)
+    occupancy_map = OccupancyMap()
+    for values in zip(*(movement[column].tolist() for column in COLUMNS)):
+        occupancy_map.update(dict(zip(COLUMNS, values)))
+    occupancy_map.snapshot(args.output)
+    if args.png:
+        with open(args.png, "wb") as f:
+            f.write(occupancy_map.render_png())
+    print(f"Swept {occupancy_map.coverage():.2f}m² in {len(occupancy_map.tiles)} tiles")
+
+
+if __name__ == "__main__":
+    main()
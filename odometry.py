@@ -0,0 +1,126 @@
+"""
+Add up every frame of the sensor stream into movement records, at whatever rate is worth saving.
+
+The wheel encoders (packets 43 and 44) are 16 bit counters that wrap around, so each frame's delta
+is taken the short way around (a wheel can't turn 32768 counts in 15ms). The wheels are kept
+separate, so turning isn't lost, and a record is finished every so often:
+
+- "100ms" (or "0.5s"): every 100ms of frames
+- "5mm": every 5mm the middle of the roomba travels (or every MAX_RECORD_INTERVAL while it's still)
+
+Each record is a movement sample like record_movement.py has always saved (so everything that reads
+them still works), plus left_delta, right_delta, and duration (in seconds).
+"""
+import math
+
+from interface import MM_PER_COUNT
+
+FRAME_INTERVAL = 0.015
+"""How often the roomba sends a stream frame"""
+MAX_RECORD_INTERVAL = 5
+"""The longest a record can go on for when they're by distance"""
+
+
+def wrap_delta(current: int, previous: int) -> int:
+    """How far a 16 bit encoder went from previous to current, either way, across a wrap around"""
+    return ((current - previous + 0x8000) & 0xFFFF) - 0x8000
+
+
+def parse_rate(value: str) -> tuple:
+    """Turn "100ms", "0.5s", or "5mm" into (seconds, millimeters), with one of them None"""
+    for suffix, scale, is_distance in (("ms", 0.001, False), ("mm", 1, True), ("s", 1, False)):
+        if value.endswith(suffix):
+            amount = float(value[: -len(suffix)]) * scale
+            if amount <= 0:
+                break
+            return (None, amount) if is_distance else (amount, None)
+    raise ValueError(f"Expected something like 100ms, 0.5s, or 5mm, not {value!r}")
+
+
+class Odometry:
+    """Turn stream frames (with the encoders, angle, and bumper packets) into movement records"""
+
+    def __init__(self, interval: float = 0.1, distance: float = None):
+        self.interval = interval
+        """How many seconds each record covers, or None to go by distance"""
+        self.distance = distance
+        """How many millimeters each record covers, or None to go by time"""
+        self.frames_per_record = (
+            max(1, round(interval / FRAME_INTERVAL))
+            if interval
+            else math.ceil(MAX_RECORD_INTERVAL / FRAME_INTERVAL)
+        )
+        self.last_left = None
+        self.last_right = None
+        self.wraps = 0
+        self._start_record()
+
+    def _start_record(self):
+        self.frames = 0
+        self.left_delta = 0
+        self.right_delta = 0
+        self.degrees_turned = 0
+        self.light_bumper = False
+        self.cliff = False
+        self.bumper_wheel_drop = False
+
+    def _record(self) -> dict:
+        record = {
+            "encoder_delta": self.left_delta + self.right_delta,
+            "degrees_turned": self.degrees_turned,
+            "light_bumper": self.light_bumper,
+            "cliff": self.cliff,
+            "bumper_wheel_drop": self.bumper_wheel_drop,
+            "left_delta": self.left_delta,
+            "right_delta": self.right_delta,
+            "duration": round(self.frames * FRAME_INTERVAL, 3),
+        }
+        self._start_record()
+        return record
+
+    def add(self, frames: list) -> list:
+        """Add frames from the stream, oldest first, and get any records they finished"""
+        records = []
+        for frame in frames:
+            if self.last_left is None:
+                # Nothing to measure from yet
+                self.last_left = frame.left_encoder
+                self.last_right = frame.right_encoder
+                continue
+            left = wrap_delta(frame.left_encoder, self.last_left)
+            right = wrap_delta(frame.right_encoder, self.last_right)
+            if frame.left_encoder - self.last_left != left:
+                self.wraps += 1
+            if frame.right_encoder - self.last_right != right:
+                self.wraps += 1
+            self.last_left = frame.left_encoder
+            self.last_right = frame.right_encoder
+            self.frames += 1
+            self.left_delta += left
+            self.right_delta += right
+            # The angle is how much it turned since the last frame
+            self.degrees_turned += frame.angle
+            self.light_bumper = self.light_bumper or frame.light_bumper > 0
+            self.cliff = (
+                self.cliff
+                or frame.cliff_left > 0
+                or frame.cliff_front_left > 0
+                or frame.cliff_front_right > 0
+                or frame.cliff_right > 0
+            )
+            self.bumper_wheel_drop = self.bumper_wheel_drop or frame.bumps_wheel_drops > 0
+            if self.frames >= self.frames_per_record or (
+                self.distance is not None
+                and (abs(self.left_delta) + abs(self.right_delta)) / 2 * MM_PER_COUNT
+                >= self.distance
+            ):
+                records.append(self._record())
+        return records
+
+    def flush(self) -> list:
+        """Finish the record that's in progress, if there's anything in it"""
+        return [self._record()] if self.frames else []
+
+    def reset(self):
+        """Start measuring from the next frame again (like after the roomba's been restarted)"""
+        self.last_left = self.last_right = None
@@ -0,0 +1,78 @@
+"""
+Decide how often to check what the roomba is doing, based on what it was doing last time.
+
+It gets checked often while it's cleaning or going home (so Home Assistant finds out about changes
+quickly), and rarely while it's docked. Right after a command, it gets checked straight away and
+then quickly for a few seconds, to confirm the command worked.
+"""
+import asyncio
+import time
+
+DEFAULT_INTERVALS = {
+    "cleaning": 2,
+    "returning": 2,
+    "paused": 10,
+    "idle": 10,
+    "error": 10,
+    "docked": 60,
+}
+"""How many seconds to wait between checks in each state"""
+
+
+class PollSchedule:
+    """Wait the right amount of time before each check"""
+
+    def __init__(
+        self,
+        intervals: dict = None,
+        min_interval: float = 0.5,
+        max_interval: float = 300,
+        confirm_interval: float = 0.5,
+        confirm_time: float = 5,
+    ):
+        self.intervals = dict(DEFAULT_INTERVALS)
+        if intervals:
+            self.intervals.update(intervals)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.confirm_interval = confirm_interval
+        """How often to check while confirming a command"""
+        self.confirm_time = confirm_time
+        """How long to keep checking quickly after a command"""
+        self.confirm_until = 0
+        self.poked = None
+
+    def interval(self, state: str) -> float:
+        """How long to wait after seeing this state"""
+        if time.monotonic() < self.confirm_until:
+            interval = self.confirm_interval
+        else:
+            interval = self.intervals.get(state, self.intervals["idle"])
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def command_sent(self):
+        """Check now, and keep checking quickly for a bit"""
+        self.confirm_until = time.monotonic() + self.confirm_time
+        if self.poked is not None:
+            self.poked.set()
+
+    async def wait(self, state: str):
+        """Wait until it's time for the next check (or a command was sent)"""
+        if self.poked is None:
+            self.poked = asyncio.Event()
+        try:
+            await asyncio.wait_for(self.poked.wait(), self.interval(state))
+        except asyncio.TimeoutError:
+            pass
+        self.poked.clear()
+
+
+def parse_intervals(values) -> dict:
+    """Turn ["cleaning=2", "docked=60"] into {"cleaning": 2.0, "docked": 60.0}"""
+    intervals = {}
+    for value in values or ():
+        state, _, seconds = value.partition("=")
+        if state not in DEFAULT_INTERVALS or not seconds:
+            raise ValueError(f"Expected state=seconds with a state from {list(DEFAULT_INTERVALS)}")
+        intervals[state] = float(seconds)
+    return intervals
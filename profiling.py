@@ -0,0 +1,182 @@
+"""
+Find out where the time and memory go, on the Pi itself. It's off unless it's asked for, with
+--profile DIRECTORY or FIOMBA_PROFILE=DIRECTORY, and then it writes to that directory:
+
+- cpu-*.folded: a sample of every thread's stack every 20ms, counted up (one "stack count" per line,
+  which flamegraph.pl and speedscope can draw)
+- memory-*.txt: what's allocated the most memory according to tracemalloc, and what's grown the most
+  since the last one
+- phases-*.jsonl: how long each part (like read, decode, publish, sleep) of each loop took, one line
+  per time around the loop
+
+New files are started every so often, and only the newest few of each are kept, so it can be left
+running for days.
+"""
+import atexit
+import collections
+import contextlib
+import glob
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import ujson
+
+ENV_VAR = "FIOMBA_PROFILE"
+SAMPLE_INTERVAL = 0.02
+"""How often to look at every thread's stack"""
+CPU_DUMP_INTERVAL = 60
+MEMORY_DUMP_INTERVAL = 300
+TRACEMALLOC_FRAMES = 5
+PHASES_FILE_SIZE = 1024 * 1024
+"""How big a phases file gets before starting a new one"""
+KEEP = 10
+"""How many files of each kind to keep"""
+TOP_ALLOCATIONS = 25
+
+_NOTHING = contextlib.nullcontext()
+
+
+class Profiler:
+    """Sample stacks and memory in the background, and time the phases of loops"""
+
+    def __init__(self, directory: str = None):
+        self.directory = directory
+        self.enabled = directory is not None
+        self.stacks = collections.Counter()
+        self.phases = {}
+        self.phases_file = None
+        self.last_snapshot = None
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """Start sampling (if profiling's on)"""
+        if not self.enabled or self._running:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._running = True
+        self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._thread.start()
+        print("Profiling to", self.directory)
+
+    def stop(self):
+        """Stop sampling, and write out what's left"""
+        if not self._running:
+            return
+        self._running = False
+        self._thread.join()
+        self._dump_cpu()
+        self._dump_memory()
+        tracemalloc.stop()
+        if self.phases_file is not None:
+            self.phases_file.close()
+            self.phases_file = None
+
+    def phase(self, loop: str, name: str):
+        """Time the code in a with block, as part of this time around the loop"""
+        if not self.enabled:
+            return _NOTHING
+        return self._time_phase(loop, name)
+
+    @contextlib.contextmanager
+    def _time_phase(self, loop: str, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            # Loops on the same event loop take turns, so each one adds up its own phases
+            phases = self.phases.setdefault(loop, {})
+            phases[name] = phases.get(name, 0) + elapsed
+
+    def iteration(self, loop: str):
+        """Save the phases timed since the last time around this loop"""
+        if not self.enabled:
+            return
+        phases = {
+            name: round(milliseconds, 3)
+            for name, milliseconds in self.phases.pop(loop, {}).items()
+        }
+        if not phases:
+            return
+        if self.phases_file is None or self.phases_file.tell() > PHASES_FILE_SIZE:
+            if self.phases_file is not None:
+                self.phases_file.close()
+            self.phases_file = open(self._path("phases", "jsonl"), "w", encoding="utf-8")
+            self._prune("phases", "jsonl")
+        self.phases_file.write(ujson.dumps({"loop": loop, "time": time.time(), **phases}) + "\n")
+
+    def _path(self, kind: str, extension: str) -> str:
+        return os.path.join(
+            self.directory, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.{extension}"
+        )
+
+    def _prune(self, kind: str, extension: str):
+        paths = sorted(glob.glob(os.path.join(self.directory, f"{kind}-*.{extension}")))
+        for path in paths[:-KEEP]:
+            os.remove(path)
+
+    def _sample(self):
+        me = threading.get_ident()
+        next_cpu_dump = time.monotonic() + CPU_DUMP_INTERVAL
+        next_memory_dump = time.monotonic() + MEMORY_DUMP_INTERVAL
+        while self._running:
+            time.sleep(SAMPLE_INTERVAL)
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+            now = time.monotonic()
+            if now >= next_cpu_dump:
+                next_cpu_dump = now + CPU_DUMP_INTERVAL
+                self._dump_cpu()
+            if now >= next_memory_dump:
+                next_memory_dump = now + MEMORY_DUMP_INTERVAL
+                self._dump_memory()
+
+    def _dump_cpu(self):
+        stacks, self.stacks = self.stacks, collections.Counter()
+        if not stacks:
+            return
+        with open(self._path("cpu", "folded"), "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        self._prune("cpu", "folded")
+
+    def _dump_memory(self):
+        if not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),)
+        )
+        current, peak = tracemalloc.get_traced_memory()
+        with open(self._path("memory", "txt"), "w", encoding="utf-8") as f:
+            f.write(f"Traced: {current / 1024:.1f}KiB now, {peak / 1024:.1f}KiB at most\n\n")
+            f.write("Biggest:\n")
+            for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                f.write(f"{stat}\n")
+            if self.last_snapshot is not None:
+                f.write("\nGrown the most since the last one:\n")
+                for stat in snapshot.compare_to(self.last_snapshot, "lineno")[:TOP_ALLOCATIONS]:
+                    f.write(f"{stat}\n")
+        self.last_snapshot = snapshot
+        self._prune("memory", "txt")
+
+
+def setup_profiling(directory: str = None) -> Profiler:
+    """Make a profiler for --profile (or FIOMBA_PROFILE), and start it if profiling's on"""
+    profiler = Profiler(directory or os.environ.get(ENV_VAR) or None)
+    profiler.start()
+    atexit.register(profiler.stop)
+    return profiler
@@ -1,112 +1,117 @@
 """
 Record the movement of the Roomba, and save it to a file for later analysis.
 
-The file is saved in the current working directory.
-
-The file format is a JSON file, with the following columns:
+The samples are saved to the movement directory in the current working directory.
+Check movement_log.py for the format, each sample has the following keys:
 
 - Amount that the Roomba has moved forwards/backwards
 - Amount that the Roomba has turned left/right (left is positive, right is negative)
 - Light bumper (true/false)
 - Cliff (true/false)
 - Bumper/wheel drop (true/false)
+- How far each wheel moved, and how long the sample covers
+
+Every frame of the sensor stream is added up (check odometry.py), and a sample is saved every
+--every (like 100ms, or 5mm of travel).
+
+With --map map.fmap, it also keeps a coverage map up to date (check occupancy_map.py), and draws it
+to map.png every so often for Home Assistant.
 """
+import argparse
+import atexit
+import os
+import signal
+import sys
 import time
 
-import serial
-import ujson
+from movement_log import MovementLog
+from occupancy_map import OccupancyMap
+from odometry import Odometry, parse_rate
+from profiling import setup_profiling
+from serial_broker import BrokerSession
+from session import RoombaSession
 
-from interface import OPCODE_SEND_SENSORS, OPCODE_START
+MAP_INTERVAL = 10
+"""How often to save the coverage map"""
 
-roomba = serial.Serial("/dev/ttyUSB0", 115200, timeout=0.1)
+parser = argparse.ArgumentParser(description="Record the movement of the Roomba")
+parser.add_argument("--port", default="/dev/ttyUSB0", help="serial port (or simulator.py's)")
+parser.add_argument("--map", help="keep a coverage map in this file (and a .png next to it)")
+parser.add_argument("--broker", help="record through serial_broker.py's socket (with server.py)")
+parser.add_argument("--profile", metavar="DIRECTORY", help="profile to this directory")
+parser.add_argument(
+    "--every", type=parse_rate, default="100ms", help="how often to save a sample (100ms, 5mm...)"
+)
+args = parser.parse_args()
+profiler = setup_profiling(args.profile)
 
+if args.broker:
+    session = BrokerSession(args.broker)
+else:
+    session = RoombaSession(args.port, min_backoff=1, max_backoff=30)
+movement_stream = session.open_stream(
+    [
+        43,  # Left wheel encoder
+        44,  # Right wheel encoder
+        20,  # Degrees
+        45,  # Light bumper
+        9,  # Cliff left
+        10,  # Cliff front left
+        11,  # Cliff front right
+        12,  # Cliff right
+        7,  # Bumper/wheel drop
+    ],
+)
+movement_log = MovementLog("movement")
+occupancy_map = OccupancyMap() if args.map else None
+last_map_save = time.monotonic()
+odometry = Odometry(*args.every)
 
-def wake_roomba():
-    """Wake up the roomba"""
-    roomba.close()
-    roomba.open()
-    time.sleep(0.05)
-    roomba.write(OPCODE_START)
-    time.sleep(0.05)
 
+def finish():
+    """Save the sample that's in progress, and close the log"""
+    for sample in odometry.flush():
+        movement_log.append(sample)
+    movement_log.close()
+    print("The encoders wrapped around", odometry.wraps, "times")
 
-last_left_encoder = None
-last_right_encoder = None
 
+atexit.register(finish)
+# systemd stops it with SIGTERM, which skips atexit unless it's turned into a normal exit
+signal.signal(signal.SIGTERM, lambda _signal_number, _frame: sys.exit(0))
 
+
+session.start()
 while True:
-    roomba.write(
-        OPCODE_SEND_SENSORS
-        + bytes(
-            [
-                9,  # Count
-                43,  # Left wheel encoder
-                44,  # Right wheel encoder
-                20,  # Degrees
-                45,  # Light bumper
-                9,  # Cliff left
-                10,  # Cliff front left
-                11,  # Cliff front right
-                12,  # Cliff right
-                7,  # Bumper/wheel drop
-            ]
-        )
-    )
-    time.sleep(0.05)
-    sensor_statuses = (
-        int.from_bytes(roomba.read(2), "big"),
-        int.from_bytes(roomba.read(2), "big"),
-        int.from_bytes(roomba.read(2), "big"),
-        int.from_bytes(roomba.read(1), "big"),
-        int.from_bytes(roomba.read(1), "big"),
-        int.from_bytes(roomba.read(1), "big"),
-        int.from_bytes(roomba.read(1), "big"),
-        int.from_bytes(roomba.read(1), "big"),
-        int.from_bytes(roomba.read(1), "big"),
-    )
-    print(sensor_statuses)
-    if not any(sensor_statuses):
+    profiler.iteration("record")
+    with profiler.phase("record", "sleep"):
+        time.sleep(0.5)
+    # The robot sends a frame every 15ms, and every one of them since last time gets added up
+    with profiler.phase("record", "read"):
+        frames = movement_stream.drain()
+    session.record_response(bool(frames))
+    if not frames:
         print("no resp")
-        wake_roomba()
-        continue
-    if last_left_encoder is None or last_right_encoder is None:
-        last_left_encoder = sensor_statuses[0]
-        last_right_encoder = sensor_statuses[1]
+        if session.needs_reopen():
+            with profiler.phase("record", "reopen"):
+                session.reopen()
+            # It might have restarted, and started counting from 0 again
+            odometry.reset()
         continue
-    encoder_delta = (sensor_statuses[0] - last_left_encoder) + (
-        sensor_statuses[1] - last_right_encoder
-    )
-    degrees_turned = sensor_statuses[2]
-    if degrees_turned > 0x8000:
-        degrees_turned = degrees_turned - 0x10000
-    light_bumper = sensor_statuses[3] > 0
-    cliff = (
-        sensor_statuses[4] > 0
-        or sensor_statuses[5] > 0
-        or sensor_statuses[6] > 0
-        or sensor_statuses[7] > 0
-    )
-    bumper_wheel_drop = sensor_statuses[8] > 0
-    try:
-        with open("movement.json") as orig_f:
-            movement_history = orig_f.read()
-            movement_history = ujson.loads(movement_history)
-    except Exception as e:
-        print("error :/")
-        print(e)
-        movement_history = []
-    with open("movement.json", "w") as f:
-        movement_history.append(
-            {
-                "encoder_delta": encoder_delta,
-                "degrees_turned": degrees_turned,
-                "light_bumper": light_bumper,
-                "cliff": cliff,
-                "bumper_wheel_drop": bumper_wheel_drop,
-            }
-        )
-        ujson.dump(movement_history, f, indent=2)
-        print(movement_history)
-    last_left_encoder = sensor_statuses[0]
-    last_right_encoder = sensor_statuses[1]
-    time.sleep(0.5)
+    print(frames[-1])
+    with profiler.phase("record", "decode"):
+        samples = odometry.add(frames)
+    with profiler.phase("record", "write"):
+        for sample in samples:
+            movement_log.append(sample)
+    if samples:
+        print(samples[-1], "encoder wraps:", odometry.wraps)
+    if occupancy_map is not None:
+        with profiler.phase("record", "map"):
+            for sample in samples:
+                occupancy_map.update(sample)
+            if time.monotonic() - last_map_save > MAP_INTERVAL:
+                last_map_save = time.monotonic()
+                occupancy_map.snapshot(args.map)
+                with open(os.path.splitext(args.map)[0] + ".png", "wb") as f:
+                    f.write(occupancy_map.render_png())
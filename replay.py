@@ -0,0 +1,330 @@
+"""
+Replay recorded runs through the real bridge, faster than they happened, to find where it falls
+behind.
+
+The movement recording is played by simulator.py (the wheels draw current while it moves, so the
+bridge sees it cleaning), and commands captured from MQTT are published to a local broker at the
+times they were sent. Both are sped up together, and it reports:
+
+- commands: how many were sent, made it to the roomba, were coalesced by command_queue.py (on
+  purpose), were rejected because the queue was full, or were lost somewhere
+- publish lag: how long it took for roomba/state to catch up whenever what it should say changed
+  (docked, moving, or idle), and how many of those changes were never published at all
+- CPU: how much the bridge used (not counting the simulator) per hour of the recording
+
+The bridge's poll schedule is sped up too (up to MAX_POLL_SPEED times), so it checks as often per
+recorded second as it would for real. Everything else (the 15ms stream, publishing every so often)
+still runs in real time, since it's about the roomba, so speeding up packs more into each of those.
+With --speed max, commands are sent back to back and a movement sample is replayed every 10ms, which
+finds the ceiling.
+
+python3 replay.py capture commands.jsonl --mqtt-host homeassistant.local
+python3 replay.py run --movement movement --commands commands.jsonl --speed 10
+"""
+import argparse
+import asyncio
+import bisect
+import itertools
+import math
+import threading
+import time
+
+import ujson
+
+import local_mqtt
+import server
+from bench import summarize
+from interface import OPCODE_CLEAN, OPCODE_DOCK, OPCODE_PLAY_SONG, OPCODE_SAFE, OPCODE_SPOT
+from polling import PollSchedule
+from session import RoombaSession
+from simulator import RoombaSimulator, load_samples
+
+SETTLE_TIME = 3
+"""How long to keep going after the last command, for the bridge to catch up (or a whole poll
+interval, if that's longer)"""
+MAX_POLL_SPEED = 20
+"""The most the poll schedule gets sped up, since checking is never instant"""
+TOPICS = ("command", "history/request")
+"""The topics that get captured and replayed (after roomba/ or roomba/<name>/)"""
+
+
+def capture(path: str, host: str):
+    """Save every command sent to any bridge until it's stopped, one JSON line each"""
+    import paho.mqtt.client as mqtt
+
+    def on_connect(client, _userdata, _flags, _rc):
+        for topic in TOPICS:
+            client.subscribe(f"roomba/{topic}")
+            client.subscribe(f"roomba/+/{topic}")
+
+    def on_message(_client, _userdata, message):
+        line = {"time": time.time(), "topic": message.topic, "payload": message.payload.decode()}
+        f.write(ujson.dumps(line, escape_forward_slashes=False) + "\n")
+        f.flush()
+
+    with open(path, "a", encoding="utf-8") as f:
+        client = mqtt.Client("fiomba-capture")
+        client.username_pw_set(server.MQTT_USERNAME, server.MQTT_PASSWORD)
+        client.on_connect = on_connect
+        client.on_message = on_message
+        client.connect(host)
+        print("Capturing commands to", path)
+        client.loop_forever()
+
+
+def load_commands(path: str) -> list:
+    """Load a capture as (seconds since the first one, topic for a single bridge, payload)"""
+    commands = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            command = ujson.loads(line)
+            for topic in TOPICS:
+                if command["topic"].endswith("/" + topic):
+                    commands.append((command["time"], f"roomba/{topic}", command["payload"]))
+                    break
+    commands.sort(key=lambda command: command[0])
+    if not commands:
+        return []
+    first = commands[0][0]
+    return [(sent_at - first, topic, payload) for sent_at, topic, payload in commands]
+
+
+def commands_reached(opcodes: dict) -> dict:
+    """How many of each command got to the roomba, going by the opcodes it received"""
+    return {
+        "start": opcodes[OPCODE_CLEAN[0]],
+        "clean_spot": opcodes[OPCODE_SPOT[0]],
+        "return_to_base": opcodes[OPCODE_DOCK[0]],
+        "locate": opcodes[OPCODE_PLAY_SONG[0]],
+        # Locate starts with SAFE too
+        "pause": opcodes[OPCODE_SAFE[0]] - opcodes[OPCODE_PLAY_SONG[0]],
+    }
+
+
+def _category(moving: bool, charging: bool) -> str:
+    if charging:
+        return "docked"
+    return "moving" if moving else "idle"
+
+
+STATE_CATEGORIES = {
+    "docked": "docked",
+    "cleaning": "moving",
+    "returning": "moving",
+    "idle": "idle",
+    "paused": "idle",
+    "error": "error",
+}
+
+
+def category_changes(changes: list) -> list:
+    """
+    Turn the simulator's changes into (time, category), leaving out the ones the bridge wouldn't
+    report (like starting to move while it's still on the dock)
+    """
+    categories = []
+    for changed_at, moving, charging in changes:
+        category = _category(moving, charging)
+        if not categories or categories[-1][1] != category:
+            categories.append((changed_at, category))
+    return categories
+
+
+def publish_lags(changes: list, published: list, since: float = -math.inf):
+    """
+    For each change in what the bridge should report since a time, how long until roomba/state said
+    so (before it changed again), and how many were never published
+    """
+    published_times = [published_at for published_at, _category in published]
+    lags = []
+    missed = 0
+    changes = category_changes(changes)
+    for number, (changed_at, category) in enumerate(changes):
+        if changed_at < since:
+            continue
+        until = changes[number + 1][0] if number + 1 < len(changes) else math.inf
+        for index in range(bisect.bisect_left(published_times, changed_at), len(published)):
+            published_at, published_category = published[index]
+            if published_at >= until:
+                missed += 1
+                break
+            if published_category == category:
+                lags.append(published_at - changed_at)
+                break
+        else:
+            missed += 1
+    return lags, missed
+
+
+def scaled_schedule(speed: float) -> PollSchedule:
+    """The bridge's usual poll schedule, sped up like the recording"""
+    speed = min(speed, MAX_POLL_SPEED)
+    usual = PollSchedule()
+    return PollSchedule(
+        {state: interval / speed for state, interval in usual.intervals.items()},
+        min_interval=usual.min_interval / speed,
+        max_interval=usual.max_interval / speed,
+        confirm_interval=usual.confirm_interval / speed,
+        confirm_time=usual.confirm_time / speed,
+    )
+
+
+def _thread_cpu(threads: list) -> float:
+    """How many CPU seconds these threads have used"""
+    seconds = 0.0
+    for thread in threads:
+        try:
+            seconds += time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+        except (OSError, TypeError):
+            # It's finished
+            pass
+    return seconds
+
+
+async def _replay(simulator: RoombaSimulator, commands: list, speed: float, samples: int) -> dict:
+    broker = local_mqtt.LocalBroker()
+    ha = broker.Client("roomba")
+    ha.connect()
+    home_assistant = broker.Client("home_assistant")
+    home_assistant.connect()
+    home_assistant.subscribe("roomba/state")
+    published = []
+    published_lock = threading.Lock()
+
+    def on_message(_client, _userdata, message):
+        state = ujson.loads(message.payload)["state"]
+        with published_lock:
+            published.append((time.perf_counter(), STATE_CATEGORIES.get(state, state)))
+
+    home_assistant.on_message = on_message
+
+    session = RoombaSession(simulator.port, min_backoff=1, max_backoff=5)
+    poll_schedule = scaled_schedule(speed)
+    bridge = server.Bridge(session, ha, poll_schedule)
+    task = asyncio.create_task(bridge.run())
+    while bridge.loop is None or session.latest() is None:
+        await asyncio.sleep(0.01)
+
+    cpu_started = time.process_time()
+    simulator_cpu_started = _thread_cpu(simulator._threads)
+    started = time.perf_counter()
+    simulator.sample_index = 0
+    for sent_at, topic, payload in commands:
+        if math.isfinite(speed):
+            await asyncio.sleep(max(0, started + sent_at / speed - time.perf_counter()))
+        else:
+            # Just give the bridge a turn
+            await asyncio.sleep(0)
+        home_assistant.publish(topic, payload)
+    while simulator.sample_index < samples:
+        await asyncio.sleep(0.1)
+    replayed = time.perf_counter() - started
+    with simulator.lock:
+        simulator.samples = []
+        simulator.replay_moving = False
+    await asyncio.sleep(max(SETTLE_TIME, *poll_schedule.intervals.values()))
+    broker.wait_until_delivered()
+    cpu = time.process_time() - cpu_started
+    simulator_cpu = _thread_cpu(simulator._threads) - simulator_cpu_started
+
+    task.cancel()
+    session.close()
+    with published_lock:
+        published = list(published)
+    reached = commands_reached(simulator.opcodes_received)
+    command_count = sum(topic.endswith("/command") for _sent_at, topic, _payload in commands)
+    coalesced = bridge.commands.duplicates + bridge.commands.superseded
+    lags, missed = publish_lags(list(simulator.state_changes), published, since=started)
+    return {
+        "wall_seconds": replayed,
+        "cpu_seconds": cpu,
+        "bridge_cpu_seconds": cpu - simulator_cpu,
+        "commands": {
+            "sent": command_count,
+            "reached_roomba": sum(reached.values()),
+            "coalesced": coalesced,
+            "rejected": bridge.commands.rejected,
+            "lost": max(
+                0, command_count - sum(reached.values()) - coalesced - bridge.commands.rejected
+            ),
+            "by_command": reached,
+        },
+        "state_changes": len(lags) + missed,
+        "state_changes_missed": missed,
+        "publish_lag": summarize(lags) if lags else None,
+        "bridge_metrics": bridge.metrics.snapshot(),
+    }
+
+
+def run(
+    movement: str = None,
+    commands_path: str = None,
+    speed: float = 1,
+    duration: float = None,
+) -> dict:
+    """Replay a movement recording and/or a command capture, and report how the bridge kept up"""
+    samples = load_samples(movement) if movement else []
+    commands = load_commands(commands_path) if commands_path else []
+    # Each sample takes as long as it did when it was recorded
+    ends = list(itertools.accumulate(sample["duration"] for sample in samples))
+    if duration is not None:
+        samples = samples[: bisect.bisect_right(ends, duration)]
+        commands = [command for command in commands if command[0] <= duration]
+    recording_seconds = max(
+        ends[len(samples) - 1] if samples else 0, commands[-1][0] if commands else 0
+    )
+    if math.isfinite(speed):
+        simulator = RoombaSimulator(samples, speed=speed).start()
+    else:
+        simulator = RoombaSimulator(samples, replay_interval=0).start()
+    try:
+        results = asyncio.run(_replay(simulator, commands, speed, len(samples)))
+    finally:
+        simulator.stop()
+    hours = recording_seconds / 3600
+    results["recording_seconds"] = recording_seconds
+    results["speed"] = recording_seconds / results["wall_seconds"] if results["wall_seconds"] else 0
+    for name in ("cpu_seconds", "bridge_cpu_seconds"):
+        results[f"{name}_per_hour"] = results[name] / hours if hours else None
+    return results
+
+
+def _speed(value: str) -> float:
+    if value == "max":
+        return math.inf
+    return float(value.rstrip("x"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded runs through the bridge")
+    commands = parser.add_subparsers(dest="action", required=True)
+    capture_parser = commands.add_parser("capture", help="save commands sent over MQTT")
+    capture_parser.add_argument("output", help="JSON lines file to add them to")
+    capture_parser.add_argument("--mqtt-host", default=server.MQTT_HOST)
+    run_parser = commands.add_parser("run", help="replay a recording through the bridge")
+    run_parser.add_argument("--movement", help="movement directory, .fmov file, or movement.json")
+    run_parser.add_argument("--commands", help="a capture from replay.py capture")
+    run_parser.add_argument("--speed", type=_speed, default=1, help="1, 10, or max (default: 1)")
+    run_parser.add_argument("--duration", type=float, help="only the first this many seconds")
+    run_parser.add_argument("-o", "--output", help="save the results as JSON")
+    args = parser.parse_args()
+
+    if args.action == "capture":
+        try:
+            capture(args.output, args.mqtt_host)
+        except KeyboardInterrupt:
+            pass
+        return
+    if not args.movement and not args.commands:
+        parser.error("run needs --movement, --commands, or both")
+    results = run(args.movement, args.commands, args.speed, args.duration)
+    if args.output:
+        with open(args.output, "w") as f:
+            ujson.dump(results, f, indent=2)
+    print(ujson.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+"""
+Tell systemd how the service is doing, for Type=notify (check fiomba.service.reference).
+
+This is the whole protocol: a datagram to the socket systemd puts in $NOTIFY_SOCKET, so there's no
+need for the systemd Python package. It doesn't do anything when systemd didn't start the process.
+"""
+import os
+import socket
+
+
+def notify(*states: str) -> bool:
+    """Send states like "READY=1" or "STATUS=Connecting", and return whether systemd got them"""
+    path = os.environ.get("NOTIFY_SOCKET")
+    if not path:
+        return False
+    if path.startswith("@"):
+        # An abstract socket
+        path = "\0" + path[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.sendto("\n".join(states).encode("utf-8"), path)
+        except OSError:
+            return False
+    return True
@@ -0,0 +1,88 @@
+"""
+Remember the newest value of every sensor packet, and only ask the roomba for the ones that are too
+old.
+
+Streams keep the cache up to date for the packets they stream, so those are always fresh while the
+roomba's responding. Packets that barely change (like the battery capacity) don't need to be in
+every 15ms frame, so they're left out of the stream and asked for with one SEND_SENSORS for all of
+the stale ones at once, only when they're older than FRESHNESS says they can be.
+"""
+import threading
+import time
+
+from interface import sensor_layout
+
+DEFAULT_FRESHNESS = 0.5
+FRESHNESS = {
+    7: 0.05,  # Bumper/wheel drop
+    9: 0.05,  # Cliff left
+    10: 0.05,  # Cliff front left
+    11: 0.05,  # Cliff front right
+    12: 0.05,  # Cliff right
+    45: 0.05,  # Light bumper
+    22: 10,  # Voltage
+    24: 30,  # Temperature
+    25: 60,  # Battery charge
+    26: 600,  # Battery capacity
+}
+"""How many seconds old each packet can be before it has to be asked for again (otherwise it's
+DEFAULT_FRESHNESS)"""
+
+
+class SensorCache:
+    """The newest value of each sensor packet, by packet ID"""
+
+    def __init__(self, session, freshness: dict = None):
+        self.session = session
+        self.freshness = {**FRESHNESS, **(freshness or {})}
+        self.values = {}
+        """The time each packet was received, and its value"""
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.queried_packets = 0
+
+    def watch(self, stream):
+        """Keep the cache up to date with the packets in a stream"""
+        packet_ids = stream.parser.packet_ids
+
+        def on_frames(received_at: float, frames: list):
+            self.update(received_at, packet_ids, frames[-1])
+
+        stream.on_frames = on_frames
+
+    def update(self, received_at: float, packet_ids, values):
+        """Save the values of some packets"""
+        with self.lock:
+            for packet_id, value in zip(packet_ids, values):
+                self.values[packet_id] = (received_at, value)
+
+    def stale(self, packet_ids) -> tuple:
+        """Which of the packets are too old (or haven't been seen at all)"""
+        now = time.monotonic()
+        values = self.values
+        return tuple(
+            packet_id
+            for packet_id in packet_ids
+            if packet_id not in values
+            or now - values[packet_id][0] > self.freshness.get(packet_id, DEFAULT_FRESHNESS)
+        )
+
+    def get(self, packet_ids):
+        """
+        Get a record of the packets (like a stream's), asking the roomba for the stale ones in one
+        go. If it doesn't answer, the old values are used, or it's None if there aren't any.
+        """
+        packet_ids = tuple(packet_ids)
+        stale = self.stale(packet_ids)
+        if stale:
+            self.queries += 1
+            self.queried_packets += len(stale)
+            record = self.session.query(stale)
+            if record is not None:
+                self.update(time.monotonic(), stale, record)
+        with self.lock:
+            if any(packet_id not in self.values for packet_id in packet_ids):
+                return None
+            return sensor_layout(packet_ids).Record._make(
+                self.values[packet_id][1] for packet_id in packet_ids
+            )
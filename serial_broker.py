@@ -0,0 +1,365 @@
+"""
+Share one roomba between server.py, record_movement.py, and anything else on the same machine.
+
+Only one program can talk to the serial port without their requests and replies getting mixed up,
+so this owns the port, streams every packet any of them needs once, and passes the frames on over a
+Unix socket. Writes from the programs are done one at a time, in the order they come in. It also
+does the waking up (reopening the port), since it's the only one that knows if the robot is quiet.
+
+python3 serial_broker.py --port /dev/ttyUSB0
+python3 server.py --broker /tmp/fiomba-serial.sock
+python3 record_movement.py --broker /tmp/fiomba-serial.sock
+
+The socket carries one JSON value per line. The broker says {"packets": [...]} first, then sends a
+list of packet values for every frame. Programs send {"write": [bytes]} or {"ensure_mode": mode}.
+"""
+import argparse
+import os
+import queue
+import socket
+import threading
+import time
+
+import ujson
+
+from interface import sensor_layout
+from session import MODE_CHANGES, OI_MODE_PACKET, RoombaSession
+from stream import SensorStream
+
+SOCKET_PATH = "/tmp/fiomba-serial.sock"
+DEFAULT_PACKETS = (
+    34,  # Charging sources (server.py)
+    56,  # Main brush current
+    54,  # Left motor current
+    55,  # Right motor current
+    25,  # Battery charge
+    26,  # Battery capacity
+    43,  # Left wheel encoder (record_movement.py)
+    44,  # Right wheel encoder
+    20,  # Degrees
+    45,  # Light bumper
+    9,  # Cliff left
+    10,  # Cliff front left
+    11,  # Cliff front right
+    12,  # Cliff right
+    7,  # Bumper/wheel drop
+)
+CLIENT_QUEUE_SIZE = 256
+"""How many lines can wait for a slow program before frames for it start getting dropped"""
+WATCH_INTERVAL = 0.5
+
+
+class SerialBroker:
+    """Own the serial port, and share it with programs that connect to a Unix socket"""
+
+    def __init__(self, session: RoombaSession, path: str = SOCKET_PATH, packet_ids=DEFAULT_PACKETS):
+        self.session = session
+        self.path = path
+        self.stream = session.open_stream(packet_ids)
+        self.stream.on_frames = self._on_frames
+        self.hello = ujson.dumps({"packets": list(self.stream.parser.packet_ids)}) + "\n"
+        self.clients = {}
+        """The queue of lines to send to each connected socket"""
+        self.clients_lock = threading.Lock()
+        self.dropped_frames = 0
+
+    def serve_forever(self):
+        """Start streaming, and take connections until the process is stopped"""
+        if os.path.exists(self.path):
+            # Left over from last time
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen()
+        self.session.start()
+        threading.Thread(target=self._watch, daemon=True).start()
+        print("Sharing", self.session.roomba.port, "on", self.path)
+        try:
+            while True:
+                client, _address = server.accept()
+                threading.Thread(target=self._handle_client, args=(client,), daemon=True).start()
+        finally:
+            server.close()
+            os.unlink(self.path)
+            self.session.close()
+
+    def _on_frames(self, _received_at: float, frames: list):
+        # This is on the stream's thread, so just queue them up and let each socket send at its pace
+        lines = "".join(ujson.dumps(list(record)) + "\n" for record in frames)
+        with self.clients_lock:
+            outgoing = list(self.clients.values())
+        for lines_queue in outgoing:
+            try:
+                lines_queue.put_nowait(lines)
+            except queue.Full:
+                self.dropped_frames += len(frames)
+
+    def _watch(self):
+        """Wake the roomba up if it stops sending frames"""
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            if self.session.latest() is None and self.session.needs_reopen():
+                try:
+                    self.session.reopen()
+                except OSError as error:
+                    print("Couldn't reopen the port:", error)
+
+    def _send_lines(self, client: socket.socket, lines_queue: queue.Queue):
+        try:
+            while True:
+                lines = lines_queue.get()
+                if lines is None:
+                    return
+                client.sendall(lines.encode("utf-8"))
+        except OSError:
+            pass
+
+    def _handle_client(self, client: socket.socket):
+        lines_queue = queue.Queue(CLIENT_QUEUE_SIZE)
+        lines_queue.put(self.hello)
+        sender = threading.Thread(target=self._send_lines, args=(client, lines_queue), daemon=True)
+        sender.start()
+        with self.clients_lock:
+            self.clients[client] = lines_queue
+        print("Connected, now sharing with", len(self.clients))
+        try:
+            for line in client.makefile("rb"):
+                try:
+                    message = ujson.loads(line)
+                    if "write" in message:
+                        self.session.write(bytes(message["write"]))
+                    elif "ensure_mode" in message:
+                        self.session.ensure_mode(message["ensure_mode"])
+                    else:
+                        print("Unknown message:", message)
+                except ValueError:
+                    print("Couldn't understand", line)
+                except OSError as error:
+                    # The port's probably being reopened, which isn't this program's fault
+                    print("Couldn't write to the roomba:", error)
+        except OSError:
+            pass
+        finally:
+            with self.clients_lock:
+                del self.clients[client]
+            # Make room for the None if it's full
+            while True:
+                try:
+                    lines_queue.put_nowait(None)
+                    break
+                except queue.Full:
+                    lines_queue.get_nowait()
+            sender.join()
+            client.close()
+            print("Disconnected, now sharing with", len(self.clients))
+
+
+class BrokerStream(SensorStream):
+    """Frames for some of the packets the broker streams, instead of straight from the port"""
+
+    def __init__(self, packet_ids, history: int = 256):
+        super().__init__(None, packet_ids, history)
+        self.packet_ids = self.parser.packet_ids
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class BrokerSession:
+    """Talk to the roomba through serial_broker.py, the same way as with a session.RoombaSession"""
+
+    def __init__(
+        self,
+        path: str = SOCKET_PATH,
+        reopen_after: int = 3,
+        min_backoff: float = 1,
+        max_backoff: float = 30,
+        connect: bool = True,
+    ):
+        self.path = path
+        self.mode = None
+        self.streams = []
+        self.lock = threading.RLock()
+        self.reopen_after = reopen_after
+        """How many checks in a row with no response it takes to reconnect"""
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = min_backoff
+        self.timeouts = 0
+        self.next_reopen = 0
+        self.reopens = 0
+        self.metrics = None
+        self.socket = None
+        self.broker_packets = None
+        self.projections = []
+        self.last_values = None
+        """When the newest frame from the broker came in, and every packet in it"""
+        if connect:
+            self._connect()
+
+    def _connect(self):
+        broker = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            broker.connect(self.path)
+        except OSError:
+            broker.close()
+            raise
+        self.socket = broker
+        lines = self.socket.makefile("rb")
+        self.broker_packets = tuple(ujson.loads(lines.readline())["packets"])
+        # Which of the broker's values each stream wants
+        self.projections = []
+        for stream in self.streams:
+            self._add_projection(stream)
+        threading.Thread(target=self._read_frames, args=(lines,), daemon=True).start()
+
+    def _add_projection(self, stream: BrokerStream):
+        missing = set(stream.packet_ids) - set(self.broker_packets)
+        if missing:
+            raise ValueError(f"The serial broker isn't streaming packets {sorted(missing)}")
+        indexes = tuple(self.broker_packets.index(packet_id) for packet_id in stream.packet_ids)
+        self.projections.append((stream, stream.parser.layout.Record, indexes))
+
+    def _read_frames(self, lines):
+        try:
+            for line in lines:
+                values = ujson.loads(line)
+                received_at = time.monotonic()
+                self.last_values = (received_at, values)
+                for stream, Record, indexes in self.projections:
+                    stream._add_frames(received_at, [Record._make(values[i] for i in indexes)])
+        except (OSError, ValueError):
+            pass
+        print("Lost the connection to the serial broker")
+
+    def open_stream(self, packet_ids) -> BrokerStream:
+        """Get frames for some of the broker's packets (it adds the OI mode, like RoombaSession)"""
+        packet_ids = tuple(packet_ids)
+        if OI_MODE_PACKET not in packet_ids:
+            packet_ids += (OI_MODE_PACKET,)
+        stream = BrokerStream(packet_ids)
+        if self.broker_packets is not None:
+            self._add_projection(stream)
+        self.streams.append(stream)
+        return stream
+
+    def query(self, packet_ids, max_age: float = 0.5):
+        """
+        Get a record of some packets from the newest frame the broker sent (it streams everything,
+        so there's nothing to ask for), or None if there hasn't been one or it doesn't have them
+        """
+        last_values = self.last_values
+        if last_values is None or time.monotonic() - last_values[0] > max_age:
+            return None
+        received_at, values = last_values
+        packet_ids = tuple(packet_ids)
+        if not set(packet_ids) <= set(self.broker_packets):
+            return None
+        return sensor_layout(packet_ids).Record._make(
+            values[self.broker_packets.index(packet_id)] for packet_id in packet_ids
+        )
+
+    def _send(self, message: dict):
+        if self.socket is None:
+            print("Not connected to the serial broker yet")
+            return
+        try:
+            self.socket.sendall((ujson.dumps(message) + "\n").encode("utf-8"))
+        except OSError as error:
+            print("Couldn't send to the serial broker:", error)
+
+    def start(self):
+        """Connect if it isn't yet, and wait for the first frame (the broker's already streaming)"""
+        if self.socket is None:
+            self._connect()
+        started = time.perf_counter()
+        for stream in self.streams:
+            if stream.wait(timeout=0.5) is not None and self.metrics is not None:
+                self.metrics.observe("serial_round_trip_ms", (time.perf_counter() - started) * 1000)
+
+    def write(self, data: bytes):
+        """Have the broker send bytes to the roomba"""
+        with self.lock:
+            if self.metrics is not None:
+                with self.metrics.time("serial_write_ms"):
+                    self._send({"write": list(data)})
+            else:
+                self._send({"write": list(data)})
+            if data and data[0] in MODE_CHANGES:
+                self.mode = MODE_CHANGES[data[0]]
+
+    def ensure_mode(self, mode: int):
+        """Have the broker make sure the roomba's in a mode that works (before any later writes)"""
+        self._send({"ensure_mode": mode})
+
+    def latest(self, max_age: float = 0.5):
+        """Get the newest frame from the first stream, and keep track of whether it's responding"""
+        if not self.streams:
+            return None
+        record = self.streams[0].latest(max_age=max_age)
+        self.record_response(record is not None)
+        if record is not None:
+            self.mode = getattr(record, "oi_mode", self.mode)
+        return record
+
+    def record_response(self, responded: bool):
+        """Count how many times in a row there hasn't been a frame"""
+        if responded:
+            self.timeouts = 0
+            self.backoff = self.min_backoff
+        else:
+            self.timeouts += 1
+            self.mode = None
+
+    def needs_reopen(self) -> bool:
+        """Whether it's been quiet long enough to try reconnecting (the broker wakes the roomba)"""
+        return self.timeouts >= self.reopen_after and time.monotonic() >= self.next_reopen
+
+    def reopen(self):
+        """Reconnect to the broker, in case it was restarted"""
+        with self.lock:
+            print("Reconnecting to", self.path, "after", self.timeouts, "timeouts")
+            if self.socket is not None:
+                self.socket.close()
+                self.socket = None
+            self.reopens += 1
+            self.next_reopen = time.monotonic() + self.backoff
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            try:
+                self._connect()
+            except OSError as error:
+                print("Couldn't connect to the serial broker:", error)
+                return
+            self.start()
+
+    def close(self):
+        with self.lock:
+            if self.socket is not None:
+                self.socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Share the roomba's serial port with programs")
+    parser.add_argument("--port", default="/dev/ttyUSB0", help="serial port (or simulator.py's)")
+    parser.add_argument("--socket", default=SOCKET_PATH)
+    parser.add_argument(
+        "--packets",
+        type=lambda value: tuple(int(packet_id) for packet_id in value.split(",")),
+        default=DEFAULT_PACKETS,
+        help="comma separated sensor packet IDs to stream",
+    )
+    args = parser.parse_args()
+    sensor_layout(args.packets)  # Check they're all real packets before opening anything
+
+    session = RoombaSession(args.port, min_backoff=1, max_backoff=30)
+    try:
+        SerialBroker(session, args.socket, args.packets).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,82 @@
 # Needed imports
 print("We'll Be Right Back")
+import argparse
+import asyncio
+import random
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import paho.mqtt.client as mqtt
 import serial
 import ujson
 
-from interface import (
-    OPCODE_CLEAN,
-    OPCODE_DOCK,
-    OPCODE_PLAY_SONG,
-    OPCODE_SAFE,
-    OPCODE_SEND_SENSORS,
-    OPCODE_SPOT,
-    OPCODE_START,
-    OPCODE_STORE_SONG,
-)
-
-# Connect to the Roomba and Home Assistant
-roomba = serial.Serial("/dev/ttyUSB0", 115200, timeout=0.1)
-ha = mqtt.Client("roomba")
-ha.username_pw_set("mqtt", "M2vRaGmH")
-ha.connect("homeassistant.local")
+from command_queue import CommandQueue
+from command_scripts import ScriptRunner
+from commands import build_script, play_song, song_length, store_song
+from interface import OPCODE_CLEAN, OPCODE_DOCK, OPCODE_SAFE, OPCODE_SPOT, OPCODE_START
+from metrics import Metrics
+from polling import PollSchedule, parse_intervals
+from profiling import Profiler, setup_profiling
+from sd_notify import notify
+from sensor_cache import SensorCache
+from serial_broker import BrokerSession
+from session import MODE_PASSIVE, RoombaSession
+from telemetry import DEFAULT_POINTS, TelemetryHistory
 
-print("*ahem*")
+STARTED = time.perf_counter()
+SERIAL_PORT = "/dev/ttyUSB0"
+MQTT_HOST = "homeassistant.local"
+MQTT_USERNAME = "mqtt"
+MQTT_PASSWORD = "M2vRaGmH"
+STREAMED_PACKETS = (
+    34,  # Is it charging?
+    56,  # Is the main brush on?
+    54,  # Is the left wheel on?
+    55,  # Is the right wheel on?
+)
+STATE_PACKETS = STREAMED_PACKETS + (
+    25,  # How charged is the battery?
+    26,  # How charged can the battery be?
+)
+"""The battery ones change slowly, so they're asked for every so often instead of streamed (check
+sensor_cache.py)"""
+PUBLISH_INTERVAL = 15
+"""How often to tell Home Assistant the state, even if it hasn't changed"""
+METRICS_INTERVAL = 60
+"""How often to publish metrics to roomba/metrics"""
+LAG_CHECK_INTERVAL = 0.5
+MQTT_MIN_BACKOFF = 1
+MQTT_MAX_BACKOFF = 60
+"""How long paho waits between reconnecting to MQTT (doubling each time)"""
+HISTORY_WINDOW = 3600
+"""How far back a history request goes if it doesn't say (check telemetry.py)"""
+AMONG_US = (
+    (64, 22),
+    (67, 22),
+    (70, 22),
+    (73, 22),
+    (70, 22),
+    (67, 22),
+    (64, 22),
+    (0, 50),
+    (64, 12),
+    (67, 12),
+    (64, 12),
+)
+COMMANDS = {
+    "start": build_script(OPCODE_CLEAN),
+    "pause": build_script(OPCODE_SAFE, OPCODE_START),
+    "return_to_base": build_script(OPCODE_DOCK),
+    "clean_spot": build_script(OPCODE_SPOT),
+    "locate": build_script(
+        OPCODE_SAFE,
+        store_song(0, AMONG_US),
+        play_song(0),
+        song_length(AMONG_US),  # Wait for the song to finish
+        OPCODE_START,
+    ),
+}
+"""What to send the roomba for each command from Home Assistant (check command_scripts.py)"""
 
 
 def to_bytes(number: int) -> bytes:
@@ -31,142 +84,341 @@ def to_bytes(number: int) -> bytes:
     return number.to_bytes(1, "big")
 
 
-def find_state():
-    """Do epic mathz to find the state of the roomba"""
-    roomba.read_all()
-    roomba.write(
-        OPCODE_SEND_SENSORS
-        + bytes(
-            [
-                6,  # 6 sensors
-                34,  # Is it charging?
-                56,  # Is the main brush on?
-                54,  # Is the left wheel on?
-                55,  # Is the right wheel on?
-                25,  # How charged is the battery?
-                26,  # How charged can the battery be?
-            ]
+class Bridge:
+    """Connects a roomba to Home Assistant"""
+
+    def __init__(
+        self,
+        session: RoombaSession,
+        ha: mqtt.Client,
+        poll_schedule: PollSchedule = None,
+        topic: str = "roomba",
+        name: str = None,
+        profiler: Profiler = None,
+    ):
+        self.session = session
+        self.ha = ha
+        self.topic = topic
+        """What the MQTT topics start with, like roomba/command and roomba/state"""
+        self.name = name
+        # Each roomba gets its own thread for the serial port, so a slow one can't hold up others
+        self.serial_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name or "serial")
+        self.poll_schedule = poll_schedule or PollSchedule()
+        self.profiler = profiler or Profiler()
+        """Times each part of each loop, if profiling's on (check profiling.py)"""
+        self.metrics = session.metrics = Metrics()
+        self.state_stream = session.open_stream(STREAMED_PACKETS)
+        self.sensors = SensorCache(session)
+        self.sensors.watch(self.state_stream)
+        self.scripts = ScriptRunner(self.write, self.log)
+        self.loop = None
+        self.commands = CommandQueue()
+        self.serial_lock = None
+        self.state_changed = None
+        self.serial_started = None
+        """Set once the first try at starting the roomba is done (whether it worked or not)"""
+        self.current_state = None
+        self.battery_level = 0
+        self.is_moving = False
+        self.is_charging = False
+        self.history = TelemetryHistory()
+        self.last_state_sent = ""
+        self.last_command = None
+
+    def find_state(self):
+        """Do epic mathz to find the state of the roomba"""
+        if self.session.latest(max_age=0.5) is None:
+            sensor_statuses = None
+        else:
+            sensor_statuses = self.sensors.get(STATE_PACKETS)
+        # Available states: cleaning, docked, paused, idle, returning, error
+        if sensor_statuses is None:
+            self.metrics.increment("unresponsive_polls")
+            self.is_moving = self.is_charging = False
+            return ("error", 0)
+        is_charging = self.is_charging = sensor_statuses.charging_sources > 0
+        is_moving = self.is_moving = (
+            sensor_statuses.main_brush_current != 0
+            or sensor_statuses.left_motor_current != 0
+            or sensor_statuses.right_motor_current != 0
         )
-    )
-    time.sleep(0.025)
-    sensor_statuses = (
-        int.from_bytes(roomba.read(1), "big"),
-        int.from_bytes(roomba.read(2), "big"),
-        int.from_bytes(roomba.read(2), "big"),
-        int.from_bytes(roomba.read(2), "big"),
-        int.from_bytes(roomba.read(2), "big"),
-        int.from_bytes(roomba.read(2), "big"),
-    )
-    is_charging = sensor_statuses[0] > 0
-    is_moving = sensor_statuses[1] > 0 or sensor_statuses[2] > 0 or sensor_statuses[3] > 0
-    try:
-        battery_level = sensor_statuses[4] / sensor_statuses[5]
-    except ZeroDivisionError:
-        battery_level = 0
-    did_not_respond = all(packet == 0 for packet in sensor_statuses)
-    # Available states: cleaning, docked, paused, idle, returning, error
-    if did_not_respond:
-        return ("error", 0)
-    if is_charging:
-        return ("docked", battery_level)
-    if is_moving:
-        return ("cleaning", battery_level)
-    return ("idle", battery_level)
-
-
-def wake_roomba():
-    """Wake up the roomba"""
-    roomba.close()
-    roomba.open()
-    time.sleep(0.05)
-    roomba.write(OPCODE_START)
-    time.sleep(0.05)
-
-
-def on_command(_client, _userdata, message):
-    command_queue.append(message.payload.decode("utf-8"))
-
-
-command_queue = []
-last_update_sent = 0
-last_state_sent = ""
-last_state_check = 0
-ha.subscribe("roomba/command")
-ha.message_callback_add("roomba/command", on_command)
-ha.loop_start()
-
-print("Let's get into it, shall we?")
-
-while True:
-    # Check what the roomba is doing
-    if time.time() - last_state_check > 10:
-        current_state, battery_level = find_state()
-        if current_state == "error" and time.time() - last_state_check > 600:
-            wake_roomba()
-            continue
-        last_state_check = time.time()
-    if time.time() - last_update_sent > 15 or current_state != last_state_sent:
-        last_update_sent = time.time()
-        last_state_sent = current_state
-        ha.publish(
-            "roomba/state",
-            ujson.dumps(
-                {"state": current_state, "battery_level": round(battery_level * 1000) / 10}
-            ),
+        try:
+            battery_level = sensor_statuses.battery_charge / sensor_statuses.battery_capacity
+        except ZeroDivisionError:
+            battery_level = 0
+        if is_charging:
+            # It's made it back, so moving again later isn't returning (unless it's told to again)
+            self.last_command = None
+            return ("docked", battery_level)
+        if is_moving:
+            if self.last_command == "return_to_base":
+                return ("returning", battery_level)
+            return ("cleaning", battery_level)
+        return ("idle", battery_level)
+
+    async def check_state(self):
+        """find_state, but on the serial thread if it has to ask the roomba for some packets"""
+        if self.sensors.stale(STATE_PACKETS):
+            return await self.on_serial(self.find_state)
+        return self.find_state()
+
+    async def on_serial(self, function, *args):
+        """Run something that uses the serial port on another thread, one thing at a time"""
+        async with self.serial_lock:
+            return await self.loop.run_in_executor(self.serial_worker, function, *args)
+
+    async def write(self, data: bytes):
+        """Write to the roomba on its serial thread (without getting in the way of a reopen)"""
+        try:
+            await self.on_serial(self.session.write, data)
+        except (serial.SerialException, OSError) as error:
+            self.log("Couldn't write to the roomba:", error)
+
+    def log(self, *message):
+        if self.name is None:
+            print(*message)
+        else:
+            print(f"[{self.name}]", *message)
+
+    def profiled(self, loop: str) -> str:
+        """What to call one of this bridge's loops when profiling"""
+        return loop if self.name is None else f"{self.name}.{loop}"
+
+    def subscribe(self):
+        self.ha.subscribe(f"{self.topic}/command")
+        self.ha.subscribe(f"{self.topic}/history/request")
+
+    def on_connect(self):
+        """Subscribe again (reconnecting loses them), and send the state that couldn't be sent"""
+        self.subscribe()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.state_changed.set)
+
+    def on_command(self, _client, _userdata, message):
+        # This gets called on paho's thread, so hand it over to the event loop
+        command = message.payload.decode("utf-8")
+        if not self.commands.put(command, time.perf_counter()):
+            self.log("Skipping command", command)
+
+    def on_history_request(self, _client, _userdata, message):
+        # On paho's thread, and the history's only touched on the event loop
+        self.loop.call_soon_threadsafe(self.answer_history_request, message.payload)
+
+    def answer_history_request(self, payload: bytes):
+        """Publish the history Home Assistant asked for"""
+        try:
+            request = ujson.loads(payload) if payload.strip() else {}
+            end = float(request.get("end", time.time()))
+            start = float(request.get("start", end - float(request.get("window", HISTORY_WINDOW))))
+            points = int(request.get("points", DEFAULT_POINTS))
+        except (ValueError, TypeError, AttributeError):
+            self.log("Bad history request:", payload)
+            return
+        with self.metrics.time("history_query_ms"):
+            history = self.history.query(start, end, points)
+        self.ha.publish(
+            request.get("response_topic", f"{self.topic}/history"), ujson.dumps(history)
         )
-        print("State:", current_state, "Battery:", battery_level)
-    if len(command_queue) > 0:
-        wake_roomba()
-        command = command_queue.pop(0)
-        print("Running command", command)
-        if command == "start":
-            roomba.write(OPCODE_CLEAN)
-        elif command == "pause":
-            roomba.write(OPCODE_SAFE)
-            time.sleep(0.05)
-            roomba.write(OPCODE_START)
-        elif command == "return_to_base":
-            roomba.write(OPCODE_DOCK)
-        elif command == "clean_spot":
-            roomba.write(OPCODE_SPOT)
-        elif command == "locate":
-            roomba.write(OPCODE_SAFE)
-            time.sleep(0.05)
-            roomba.write(
-                OPCODE_STORE_SONG
-                + bytes(
-                    [
-                        0,
-                        11,
-                        64,
-                        22,
-                        67,
-                        22,
-                        70,
-                        22,
-                        73,
-                        22,
-                        70,
-                        22,
-                        67,
-                        22,
-                        64,
-                        22,
-                        0,
-                        50,
-                        64,
-                        12,
-                        67,
-                        12,
-                        64,
-                        12,
-                    ]
+
+    async def poll_state(self):
+        """Check what the roomba is doing, more often when it's busy"""
+        await self.serial_started.wait()
+        profiler = self.profiler
+        loop_name = self.profiled("poll")
+        while True:
+            profiler.iteration(loop_name)
+            with profiler.phase(loop_name, "read"):
+                current_state, battery_level = await self.check_state()
+            if current_state == "error" and self.session.needs_reopen():
+                with profiler.phase(loop_name, "reopen"):
+                    try:
+                        await self.on_serial(self.session.reopen)
+                    except (serial.SerialException, OSError) as error:
+                        # It's probably unplugged, so try again after backing off
+                        self.log("Couldn't reopen the roomba:", error)
+                    current_state, battery_level = await self.check_state()
+            self.current_state = current_state
+            self.battery_level = battery_level
+            with profiler.phase(loop_name, "history"):
+                self.history.add(
+                    time.time(), current_state, battery_level, self.is_moving, self.is_charging
                 )
-            )  # Among Us
-            time.sleep(0.05)
-            roomba.write(OPCODE_PLAY_SONG + b"\x00")
-            time.sleep(22 * 7 / 64 + 50 / 64 + 12 * 3 / 64)
-            roomba.write(OPCODE_START)
-        else:
-            print("Unknown command:", command)
-    time.sleep(0.25)
+            if current_state != self.last_state_sent:
+                self.state_changed.set()
+            with profiler.phase(loop_name, "sleep"):
+                await self.poll_schedule.wait(current_state)
+
+    async def publish_state(self):
+        """Tell Home Assistant the state when it changes, and every so often anyway"""
+        profiler = self.profiler
+        loop_name = self.profiled("publish")
+        while True:
+            profiler.iteration(loop_name)
+            with profiler.phase(loop_name, "sleep"):
+                try:
+                    await asyncio.wait_for(self.state_changed.wait(), PUBLISH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            self.state_changed.clear()
+            if self.current_state is None:
+                continue
+            with self.metrics.time("mqtt_publish_ms"), profiler.phase(loop_name, "publish"):
+                info = self.ha.publish(
+                    f"{self.topic}/state",
+                    ujson.dumps(
+                        {
+                            "state": self.current_state,
+                            "battery_level": round(self.battery_level * 1000) / 10,
+                        }
+                    ),
+                )
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                # Not connected, so on_connect will send the newest state once it is
+                continue
+            self.last_state_sent = self.current_state
+            self.log("State:", self.current_state, "Battery:", self.battery_level)
+
+    async def run_commands(self):
+        """Start commands as soon as they come in"""
+        profiler = self.profiler
+        loop_name = self.profiled("command")
+        while True:
+            profiler.iteration(loop_name)
+            with profiler.phase(loop_name, "wait"):
+                command, received_at = await self.commands.get()
+            self.metrics.observe("command_wait_ms", (time.perf_counter() - received_at) * 1000)
+            if command not in COMMANDS:
+                self.log("Unknown command:", command)
+                continue
+            # A new command replaces whatever's still running, like pausing during locate
+            self.scripts.cancel()
+            try:
+                with profiler.phase(loop_name, "serial_write"):
+                    await self.on_serial(self.session.ensure_mode, MODE_PASSIVE)
+            except (serial.SerialException, OSError) as error:
+                self.log("Couldn't run", command, "because the roomba isn't there:", error)
+                continue
+            self.log("Running command", command)
+            self.last_command = command
+            self.scripts.run(command, COMMANDS[command])
+            self.poll_schedule.command_sent()
+            # Let it write something before the next command can cancel it
+            await self.scripts.wait_started()
+
+    async def start_serial(self):
+        """Start talking to the roomba, without holding up everything else"""
+        try:
+            await self.on_serial(self.session.start)
+        except (serial.SerialException, OSError) as error:
+            self.log("Couldn't start the roomba yet:", error)
+            # Have poll_state retry straight away, and back off from there
+            self.session.timeouts = self.session.reopen_after
+        finally:
+            self.serial_started.set()
+
+    async def check_lag(self):
+        """Keep track of how late the event loop wakes up, which is how long something blocked it"""
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(LAG_CHECK_INTERVAL)
+            lag = time.perf_counter() - started - LAG_CHECK_INTERVAL
+            self.metrics.observe("loop_lag_ms", max(0, lag) * 1000)
+
+    async def publish_metrics(self):
+        """Tell Home Assistant how the bridge is doing every so often"""
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            self.metrics.set("command_queue_depth", self.commands.qsize())
+            self.metrics.set("commands_duplicate", self.commands.duplicates)
+            self.metrics.set("commands_superseded", self.commands.superseded)
+            self.metrics.set("commands_rejected", self.commands.rejected)
+            self.metrics.set("port_reopens", self.session.reopens)
+            self.metrics.set("stream_skipped_bytes", self.state_stream.parser.skipped_bytes)
+            self.metrics.set("stream_bad_frames", self.state_stream.parser.bad_frames)
+            self.metrics.set("sensor_queries", self.sensors.queries)
+            self.ha.publish(f"{self.topic}/metrics", ujson.dumps(self.metrics.snapshot()))
+
+    async def run(self):
+        """Start everything up, and keep it running"""
+        self.loop = asyncio.get_running_loop()
+        self.commands.attach(self.loop)
+        self.serial_lock = asyncio.Lock()
+        self.state_changed = asyncio.Event()
+        self.serial_started = asyncio.Event()
+        self.ha.message_callback_add(f"{self.topic}/command", self.on_command)
+        self.ha.message_callback_add(f"{self.topic}/history/request", self.on_history_request)
+        self.subscribe()
+        self.log("Let's get into it, shall we?")
+        await asyncio.gather(
+            self.start_serial(),
+            self.poll_state(),
+            self.publish_state(),
+            self.run_commands(),
+            self.check_lag(),
+            self.publish_metrics(),
+        )
+
+
+def start_mqtt(ha: mqtt.Client, host: str, bridges: list):
+    """Connect to MQTT in the background, and keep reconnecting whenever it drops"""
+    # Paho doubles the wait each time, and starting it somewhere random keeps everything that lost
+    # the broker at the same time from coming back at the same time
+    ha.reconnect_delay_set(random.uniform(MQTT_MIN_BACKOFF, MQTT_MIN_BACKOFF * 2), MQTT_MAX_BACKOFF)
+
+    def on_connect(_client, _userdata, _flags, rc):
+        if rc != 0:
+            print("MQTT refused the connection:", mqtt.connack_string(rc))
+            return
+        for bridge in bridges:
+            bridge.on_connect()
+
+    ha.on_connect = on_connect
+    ha.connect_async(host)
+    ha.loop_start()
+
+
+async def serve(bridges: list):
+    """Run the bridges, and tell systemd it's ready as soon as they've started"""
+    tasks = [asyncio.create_task(bridge.run()) for bridge in bridges]
+    # Let them get going, but not wait for the roomba or MQTT
+    await asyncio.sleep(0)
+    notify("READY=1", f"STATUS=Bridging {len(bridges)} roomba(s)")
+    print(f"Ready after {(time.perf_counter() - STARTED) * 1000:.0f}ms")
+    await asyncio.gather(*tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Connect a roomba to Home Assistant")
+    parser.add_argument("--port", default=SERIAL_PORT, help="serial port (or simulator.py's)")
+    parser.add_argument("--broker", help="use serial_broker.py's socket instead of the port")
+    parser.add_argument("--mqtt-host", default=MQTT_HOST)
+    parser.add_argument(
+        "--poll-interval",
+        action="append",
+        metavar="STATE=SECONDS",
+        help="how often to check in a state, like cleaning=2 or docked=60 (can be repeated)",
+    )
+    parser.add_argument("--min-poll-interval", type=float, default=0.5)
+    parser.add_argument("--max-poll-interval", type=float, default=300)
+    parser.add_argument("--profile", metavar="DIRECTORY", help="profile to this directory")
+    args = parser.parse_args()
+    profiler = setup_profiling(args.profile)
+    poll_schedule = PollSchedule(
+        parse_intervals(args.poll_interval), args.min_poll_interval, args.max_poll_interval
+    )
+
+    # Connecting to the Roomba and Home Assistant happens in the background, and keeps retrying
+    if args.broker:
+        session = BrokerSession(args.broker, connect=False)
+    else:
+        session = RoombaSession(args.port, connect=False)
+    ha = mqtt.Client("roomba")
+    ha.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    bridge = Bridge(session, ha, poll_schedule, profiler=profiler)
+    start_mqtt(ha, args.mqtt_host, [bridge])
+    print("*ahem*")
+    asyncio.run(serve([bridge]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+Keep the serial port to the Roomba open, and keep track of what mode it's in.
+
+Reopening the port wakes the roomba up (it toggles the lines that the BRC pin is wired to), but it's
+slow and drops anything in flight, so it only happens after the roomba stops responding for a while,
+backing off more every time it doesn't help (with some jitter, so a flapping USB port doesn't end up
+being hit at the same moments over and over). Before a command, a roomba that isn't responding just
+gets the lines pulsed and its streams asked for again, which is quick and doesn't count as a reopen.
+"""
+import random
+import threading
+import time
+
+import serial
+
+from interface import (
+    OPCODE_CLEAN,
+    OPCODE_DOCK,
+    OPCODE_FULL,
+    OPCODE_POWER,
+    OPCODE_RESET,
+    OPCODE_SAFE,
+    OPCODE_SPOT,
+    OPCODE_START,
+    OPCODE_STOP,
+    sensor_layout,
+)
+from stream import SensorStream
+
+# The same numbers the roomba uses in sensor packet 35
+MODE_OFF = 0
+MODE_PASSIVE = 1
+MODE_SAFE = 2
+MODE_FULL = 3
+MODE_NAMES = {MODE_OFF: "off", MODE_PASSIVE: "passive", MODE_SAFE: "safe", MODE_FULL: "full"}
+
+MODE_CHANGES = {
+    OPCODE_START[0]: MODE_PASSIVE,
+    OPCODE_SAFE[0]: MODE_SAFE,
+    OPCODE_FULL[0]: MODE_FULL,
+    OPCODE_CLEAN[0]: MODE_PASSIVE,
+    OPCODE_SPOT[0]: MODE_PASSIVE,
+    OPCODE_DOCK[0]: MODE_PASSIVE,
+    OPCODE_POWER[0]: MODE_OFF,
+    OPCODE_STOP[0]: MODE_OFF,
+    OPCODE_RESET[0]: MODE_OFF,
+}
+"""What mode each opcode leaves the roomba in"""
+OI_MODE_PACKET = 35
+
+
+class RoombaSession:
+    """An open serial port to the roomba, and what mode it's probably in"""
+
+    def __init__(
+        self,
+        port: str,
+        baudrate: int = 115200,
+        timeout: float = 0.1,
+        reopen_after: int = 3,
+        min_backoff: float = 10,
+        max_backoff: float = 600,
+        connect: bool = True,
+    ):
+        if connect:
+            self.roomba = serial.Serial(port, baudrate, timeout=timeout)
+        else:
+            # Opened by start() instead, so it can be retried without the whole process restarting
+            self.roomba = serial.Serial(None, baudrate, timeout=timeout)
+            self.roomba.port = port
+        self.mode = None
+        """The mode the roomba's in, or None if we don't know"""
+        self.streams = []
+        self.lock = threading.RLock()
+        self.reopen_after = reopen_after
+        """How many checks in a row with no response it takes to reopen the port"""
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = min_backoff
+        self.timeouts = 0
+        self.next_reopen = 0
+        self.reopens = 0
+        self.metrics = None
+        """A metrics.Metrics to keep track of serial timings in, if there is one"""
+
+    def open_stream(self, packet_ids) -> SensorStream:
+        """Make a sensor stream on this port (it also streams the OI mode, to keep track of it)"""
+        packet_ids = tuple(packet_ids)
+        if OI_MODE_PACKET not in packet_ids:
+            packet_ids += (OI_MODE_PACKET,)
+        stream = SensorStream(self.roomba, packet_ids)
+        self.streams.append(stream)
+        return stream
+
+    def start(self):
+        """Open the port if needed, start the OI and any streams, and wait for the first frame"""
+        with self.lock:
+            if not self.roomba.is_open:
+                self.roomba.open()
+            self.write(OPCODE_START)
+            time.sleep(0.02)
+            started = time.perf_counter()
+            for stream in self.streams:
+                stream.start()
+            for stream in self.streams:
+                if stream.wait(timeout=0.5) is not None and self.metrics is not None:
+                    self.metrics.observe(
+                        "serial_round_trip_ms", (time.perf_counter() - started) * 1000
+                    )
+
+    def write(self, data: bytes):
+        """Send bytes to the roomba, keeping track of the mode they put it in"""
+        with self.lock:
+            if self.metrics is not None:
+                with self.metrics.time("serial_write_ms"):
+                    self.roomba.write(data)
+            else:
+                self.roomba.write(data)
+            if data and data[0] in MODE_CHANGES:
+                self.mode = MODE_CHANGES[data[0]]
+
+    def query(self, packet_ids):
+        """
+        Ask for some packets with SEND_SENSORS, and get a record of them (or None if the reply
+        didn't all come). Streams are paused while waiting, since they'd read the reply otherwise.
+        """
+        layout = sensor_layout(tuple(packet_ids))
+        with self.lock:
+            streaming = [stream for stream in self.streams if stream.running]
+            for stream in streaming:
+                stream.pause()
+            if streaming:
+                # Let the frame that was being sent finish, and throw it away
+                time.sleep(0.015)
+                self.roomba.reset_input_buffer()
+            try:
+                if self.metrics is not None:
+                    with self.metrics.time("serial_query_ms"):
+                        return layout.query(self.roomba)
+                return layout.query(self.roomba)
+            finally:
+                for stream in streaming:
+                    stream.resume()
+
+    def ensure_mode(self, mode: int):
+        """Only send START/SAFE/FULL if the roomba isn't already in a mode that works"""
+        with self.lock:
+            if self.latest() is None and self.streams:
+                # It's probably asleep
+                if self.needs_reopen():
+                    self.reopen()
+                else:
+                    self.wake()
+            if self.mode is None or self.mode == MODE_OFF:
+                self.write(OPCODE_START)
+                time.sleep(0.02)
+            if mode == MODE_SAFE and self.mode != MODE_SAFE:
+                self.write(OPCODE_SAFE)
+            elif mode == MODE_FULL and self.mode != MODE_FULL:
+                self.write(OPCODE_FULL)
+
+    def latest(self, max_age: float = 0.5):
+        """Get the newest frame from the first stream, and keep track of whether it's responding"""
+        if not self.streams:
+            return None
+        record = self.streams[0].latest(max_age=max_age)
+        self.record_response(record is not None)
+        if record is not None:
+            self.mode = getattr(record, "oi_mode", self.mode)
+        return record
+
+    def record_response(self, responded: bool):
+        """Count how many times in a row the roomba hasn't responded"""
+        if responded:
+            self.timeouts = 0
+            self.backoff = self.min_backoff
+        else:
+            self.timeouts += 1
+            self.mode = None
+
+    def needs_reopen(self) -> bool:
+        """Whether the roomba's been quiet for long enough that reopening the port might help"""
+        return self.timeouts >= self.reopen_after and time.monotonic() >= self.next_reopen
+
+    def reopen(self):
+        """Close and reopen the port to wake the roomba up, then start everything again"""
+        with self.lock:
+            print("Reopening", self.roomba.port, "after", self.timeouts, "timeouts")
+            # Back off first, so it still does if the port's gone and opening it fails
+            self.mode = None
+            self.reopens += 1
+            self.next_reopen = time.monotonic() + self.backoff * random.uniform(0.5, 1.5)
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            for stream in self.streams:
+                stream.stop()
+            self.roomba.close()
+            self.roomba.open()
+            time.sleep(0.05)
+            self.start()
+
+    def wake(self):
+        """Pulse the lines BRC is wired to (like reopening does) and ask for the streams again"""
+        with self.lock:
+            try:
+                self.roomba.dtr = self.roomba.rts = False
+                time.sleep(0.05)
+                self.roomba.dtr = self.roomba.rts = True
+            except (serial.SerialException, OSError):
+                # There aren't any lines to pulse (like on the simulator's pty)
+                pass
+            self.write(OPCODE_START)
+            time.sleep(0.02)
+            for stream in self.streams:
+                stream.start()
+
+    def close(self):
+        """Stop the streams and close the port"""
+        with self.lock:
+            for stream in self.streams:
+                stream.stop()
+            self.roomba.close()
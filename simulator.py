@@ -0,0 +1,438 @@
+"""
+Pretend to be a Roomba on a pseudo-terminal, for testing and benchmarking without the real robot.
+
+It speaks the Open Interface opcodes from interface.py: it keeps track of the mode, answers
+SEND_SENSORS/SENSOR requests, sends STREAM_SENSORS frames every 15ms, and reacts to cleaning,
+docking, and song commands. Movement can be made up, or replayed from a recording.
+It can also add latency, drop bytes, and stop responding for a while, like the real one does.
+
+Run it on its own and point the scripts at the port it prints:
+
+python3 simulator.py --replay movement.json --unresponsive 30:10
+python3 server.py --port /dev/pts/4 --mqtt-host localhost
+
+Or run the whole bridge in this process, with a local stand-in for the MQTT broker
+(type commands like start, pause, or locate):
+
+python3 simulator.py --bridge
+"""
+import argparse
+import asyncio
+import collections
+import os
+import random
+import threading
+import time
+import tty
+
+from interface import MM_PER_COUNT, SENSOR_PACKETS, STREAM_HEADER, sensor_layout
+from movement_log import DEFAULT_DURATION
+
+ARGUMENT_COUNTS = {
+    128: 0,  # Start
+    7: 0,  # Reset
+    173: 0,  # Stop
+    129: 1,  # Baud
+    131: 0,  # Safe
+    132: 0,  # Full
+    135: 0,  # Clean
+    134: 0,  # Spot
+    143: 0,  # Dock
+    133: 0,  # Power
+    167: 15,  # Schedule
+    168: 3,  # Clock
+    137: 4,  # Drive
+    145: 4,  # Drive direct
+    146: 4,  # Drive PWM
+    138: 1,  # Motors
+    144: 3,  # Motors PWM
+    139: 3,  # LEDs
+    162: 2,  # Schedule LEDs
+    163: 4,  # Schedule display
+    165: 1,  # Buttons
+    164: 4,  # Schedule display ASCII
+    141: 1,  # Play song
+    142: 1,  # Sensor
+    150: 1,  # Change stream status
+}
+"""How many data bytes come after each opcode (store song, send sensors, and stream are special)"""
+STREAM_INTERVAL = 0.015
+MOTOR_CURRENT = 200
+"""How many mA the motors draw while cleaning"""
+DOCKING_TIME = 5
+"""How long it takes to get back to the dock"""
+
+
+def load_samples(path: str) -> list:
+    """Load a movement recording (a movement directory, .fmov file, or movement.json)"""
+    # Only needed for replaying, and it pulls in NumPy
+    from visualize_movement import load_movement
+
+    movement = load_movement(path)
+    # JSON logs load as floats, but the encoders only count in whole steps
+    types = {"encoder_delta": int, "degrees_turned": int, "duration": float}
+    columns = {
+        column: values.astype(types.get(column, bool)) for column, values in movement.items()
+    }
+    return [
+        {column: values[index].item() for column, values in columns.items()}
+        for index in range(len(movement["encoder_delta"]))
+    ]
+
+
+class RoombaSimulator:
+    """A fake roomba on the other end of a pseudo-terminal"""
+
+    def __init__(
+        self,
+        samples: list = None,
+        replay_interval: float = None,
+        speed: float = 1,
+        latency: float = 0,
+        drop_rate: float = 0,
+        seed: int = None,
+    ):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        """Open this with pyserial, like /dev/ttyUSB0"""
+        self.samples = samples or []
+        self.replay_interval = replay_interval
+        """Seconds between replayed samples, or None for each sample's own duration"""
+        self.speed = speed
+        """How much faster than recorded to replay samples by their durations"""
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.write_lock = threading.Lock()
+        self.raw = {packet_id: 0 for packet_id in SENSOR_PACKETS}
+        self.raw[21] = 2  # Full charging
+        self.raw[22] = 15600
+        self.raw[24] = 25
+        self.raw[25] = 2500
+        self.raw[26] = 3000
+        self.raw[34] = 2  # On the home base
+        self.pending_angle = 0
+        self.pending_distance = 0
+        self.songs = {}
+        self.song_ends = 0
+        self.cleaning = False
+        self.docking_until = None
+        self.stream_ids = None
+        self.streaming = False
+        self.unresponsive_until = 0
+        self.sample_index = 0
+        self.received = bytearray()
+        self.commands_received = 0
+        self.opcodes_received = collections.Counter()
+        self.replay_moving = False
+        """Whether the last replayed sample moved (the wheels draw current while it does)"""
+        self.state = None
+        self.state_changes = []
+        """When it started or stopped moving or charging, as (perf_counter(), moving, charging)"""
+        self.bytes_sent = 0
+        self.bytes_dropped = 0
+        self.on_receive = None
+        """Called with time.perf_counter() and the bytes, whenever bytes come in"""
+        self._running = False
+        self._threads = []
+
+    @property
+    def mode(self) -> int:
+        return self.raw[35]
+
+    def start(self):
+        """Start answering on the pseudo-terminal"""
+        self._running = True
+        for target in (self._read_commands, self._send_stream, self._update):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """Stop answering and close the pseudo-terminal"""
+        self._running = False
+        os.close(self.slave)
+        os.close(self.master)
+
+    def set_unresponsive(self, seconds: float):
+        """Ignore everything for a while, like when the roomba's asleep"""
+        self.unresponsive_until = time.monotonic() + seconds
+
+    @property
+    def unresponsive(self) -> bool:
+        return time.monotonic() < self.unresponsive_until
+
+    def _send(self, data: bytes):
+        if self.unresponsive:
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        if self.drop_rate:
+            kept = bytes(byte for byte in data if self.random.random() >= self.drop_rate)
+            self.bytes_dropped += len(data) - len(kept)
+            data = kept
+        with self.write_lock:
+            try:
+                os.write(self.master, data)
+            except OSError:
+                return
+        self.bytes_sent += len(data)
+
+    def _read_commands(self):
+        while self._running:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                # Nothing has the port open right now
+                time.sleep(0.01)
+                continue
+            if not data:
+                continue
+            if self.on_receive is not None:
+                self.on_receive(time.perf_counter(), data)
+            if self.unresponsive:
+                continue
+            self.received += data
+            self._handle_commands()
+
+    def _command_length(self):
+        """How long the next command in the buffer is, or None if it hasn't all come yet"""
+        received = self.received
+        opcode = received[0]
+        if opcode == 140:
+            if len(received) < 3:
+                return None
+            return 3 + received[2] * 2
+        if opcode in (148, 149):
+            if len(received) < 2:
+                return None
+            return 2 + received[1]
+        return 1 + ARGUMENT_COUNTS.get(opcode, 0)
+
+    def _handle_commands(self):
+        while self.received:
+            length = self._command_length()
+            if length is None or len(self.received) < length:
+                return
+            command = bytes(self.received[:length])
+            del self.received[:length]
+            self.commands_received += 1
+            self.opcodes_received[command[0]] += 1
+            with self.lock:
+                self._handle_command(command[0], command[1:])
+
+    def _handle_command(self, opcode: int, data: bytes):
+        if opcode == 128:
+            self.raw[35] = 1
+            return
+        if opcode in (7, 173, 133):
+            self.raw[35] = 0
+            self.streaming = False
+            self.cleaning = False
+            return
+        if self.mode == 0:
+            # The OI hasn't been started, so it ignores everything else
+            return
+        if opcode in (131, 132):
+            self.raw[35] = 2 if opcode == 131 else 3
+            self.cleaning = False
+            self.docking_until = None
+        elif opcode in (135, 134):
+            self.raw[35] = 1
+            self.cleaning = True
+            self.docking_until = None
+            self.raw[34] = 0
+        elif opcode == 143:
+            self.raw[35] = 1
+            self.cleaning = True
+            self.docking_until = time.monotonic() + DOCKING_TIME
+        elif opcode == 140:
+            self.songs[data[0]] = data[2:]
+        elif opcode == 141:
+            song = self.songs.get(data[0], b"")
+            self.raw[36] = data[0]
+            self.song_ends = time.monotonic() + sum(song[1::2]) / 64
+        elif opcode == 142:
+            self._send(self._packet_data((data[0],)))
+        elif opcode == 149:
+            self._send(self._packet_data(tuple(data[1:])))
+        elif opcode == 148:
+            packet_ids = tuple(data[1:])
+            if all(packet_id in SENSOR_PACKETS for packet_id in packet_ids):
+                self.stream_ids = packet_ids
+                self.streaming = True
+        elif opcode == 150:
+            self.streaming = bool(data[0]) and self.stream_ids is not None
+
+    def _values(self, packet_ids) -> list:
+        values = []
+        for packet_id in packet_ids:
+            if packet_id == 20:
+                values.append(self.pending_angle)
+                self.pending_angle = 0
+            elif packet_id == 19:
+                values.append(round(self.pending_distance))
+                self.pending_distance = 0
+            elif packet_id == 37:
+                values.append(int(time.monotonic() < self.song_ends))
+            elif packet_id == 38:
+                values.append(len(self.stream_ids or ()))
+            else:
+                values.append(self.raw[packet_id])
+        return values
+
+    def _packet_data(self, packet_ids) -> bytes:
+        if not all(packet_id in SENSOR_PACKETS for packet_id in packet_ids):
+            return b""
+        return sensor_layout(packet_ids).struct.pack(*self._values(packet_ids))
+
+    def _frame(self, packet_ids) -> bytes:
+        layout = sensor_layout(packet_ids)
+        fields = [STREAM_HEADER, layout.frame_byte_count]
+        for packet_id, value in zip(packet_ids, self._values(packet_ids)):
+            fields += (packet_id, value)
+        frame = bytearray(layout.frame_struct.pack(*fields, 0))
+        frame[-1] = -sum(frame) & 0xFF
+        return bytes(frame)
+
+    def _send_stream(self):
+        next_frame = time.monotonic()
+        while self._running:
+            next_frame += STREAM_INTERVAL
+            with self.lock:
+                frame = None
+                if self.streaming and self.mode != 0:
+                    frame = self._frame(self.stream_ids)
+            if frame is not None:
+                self._send(frame)
+            time.sleep(max(0, next_frame - time.monotonic()))
+
+    def _update(self):
+        next_sample = time.monotonic()
+        while self._running:
+            time.sleep(0.01)
+            now = time.monotonic()
+            with self.lock:
+                if self.docking_until is not None and now > self.docking_until:
+                    self.cleaning = False
+                    self.docking_until = None
+                    self.raw[34] = 2
+                while self.samples and now >= next_sample:
+                    sample = self.samples[self.sample_index % len(self.samples)]
+                    if self.replay_interval is not None:
+                        interval = self.replay_interval
+                    else:
+                        interval = sample.get("duration", DEFAULT_DURATION) / self.speed
+                    self._replay(sample)
+                    self.sample_index += 1
+                    if not interval:
+                        next_sample = now
+                        break
+                    # Keep to the recording's pace, even though this only wakes up every 10ms
+                    next_sample = max(next_sample + interval, now - 1)
+                moving = self.cleaning or self.replay_moving
+                self.raw[54] = self.raw[55] = MOTOR_CURRENT if moving else 0
+                self.raw[56] = MOTOR_CURRENT if self.cleaning else 0
+                state = (moving, self.raw[34] > 0)
+                if state != self.state:
+                    self.state = state
+                    self.state_changes.append((time.perf_counter(), *state))
+
+    def _replay(self, sample: dict):
+        left = sample["encoder_delta"] // 2
+        right = sample["encoder_delta"] - left
+        self.raw[43] = (self.raw[43] + left) & 0xFFFF
+        self.raw[44] = (self.raw[44] + right) & 0xFFFF
+        self.pending_angle = max(-32768, min(32767, self.pending_angle + sample["degrees_turned"]))
+        self.pending_distance += sample["encoder_delta"] / 2 * MM_PER_COUNT
+        self.raw[45] = 1 if sample["light_bumper"] else 0
+        self.raw[9] = 1 if sample["cliff"] else 0
+        self.raw[7] = 1 if sample["bumper_wheel_drop"] else 0
+        self.replay_moving = bool(sample["encoder_delta"] or sample["degrees_turned"])
+        if self.replay_moving:
+            # It can't be moving and still be on the dock
+            self.raw[34] = 0
+
+
+async def run_bridge(simulator: RoombaSimulator):
+    """Run the real bridge against the simulator, with a local MQTT broker"""
+    import local_mqtt
+    import server
+    from session import RoombaSession
+
+    broker = local_mqtt.LocalBroker()
+    ha = broker.Client("roomba")
+    watcher = broker.Client("watcher")
+    watcher.connect()
+    watcher.subscribe("roomba/#")
+    watcher.on_message = lambda _client, _userdata, message: print(
+        message.topic, message.payload.decode("utf-8")
+    )
+    ha.connect()
+    bridge = server.Bridge(RoombaSession(simulator.port), ha)
+    task = asyncio.create_task(bridge.run())
+    loop = asyncio.get_running_loop()
+    print("Type a command (start, pause, return_to_base, clean_spot, locate)")
+    while True:
+        command = await loop.run_in_executor(None, input)
+        watcher.publish("roomba/command", command.strip())
+        if task.done():
+            task.result()
+
+
+def _unresponsive_period(value: str) -> tuple:
+    """Turn "START:SECONDS" into (seconds after starting, how many seconds it lasts)"""
+    try:
+        start, seconds = (float(part) for part in value.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected START:SECONDS, like 30:10, not {value!r}")
+    return start, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pretend to be a Roomba on a pseudo-terminal")
+    parser.add_argument("--replay", help="movement directory, .fmov file, or movement.json")
+    parser.add_argument(
+        "--replay-interval", type=float, help="seconds between samples (default: as recorded)"
+    )
+    parser.add_argument("--speed", type=float, default=1, help="replay faster than recorded")
+    parser.add_argument("--latency", type=float, default=0, help="seconds before each reply")
+    parser.add_argument("--drop-rate", type=float, default=0, help="chance of dropping each byte")
+    parser.add_argument(
+        "--unresponsive",
+        type=_unresponsive_period,
+        action="append",
+        default=[],
+        metavar="START:SECONDS",
+        help="ignore everything for SECONDS, START seconds in (can be given more than once)",
+    )
+    parser.add_argument("--bridge", action="store_true", help="run the bridge in this process")
+    args = parser.parse_args()
+
+    samples = load_samples(args.replay) if args.replay else None
+    simulator = RoombaSimulator(
+        samples, args.replay_interval, args.speed, args.latency, args.drop_rate
+    )
+    simulator.start()
+    print("Simulating a roomba on", simulator.port)
+    for start, seconds in args.unresponsive:
+        timer = threading.Timer(start, simulator.set_unresponsive, (seconds,))
+        timer.daemon = True
+        timer.start()
+    try:
+        if args.bridge:
+            asyncio.run(run_bridge(simulator))
+        else:
+            while True:
+                time.sleep(1)
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
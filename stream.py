@@ -0,0 +1,205 @@
+"""
+Stream sensor packets from the Roomba, instead of asking for them and waiting every time.
+
+After OPCODE_STREAM_SENSORS, the robot sends a frame with the requested packets every 15ms.
+Frames are checked against their length and checksum, and anything corrupt is skipped until the
+next good header, so one late or dropped byte doesn't shift every field after it.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+import serial
+
+from interface import OPCODE_CHANGE_STREAM_STATUS, STREAM_HEADER, sensor_layout
+
+
+class StreamParser:
+    """Split bytes from the robot into frames, and decode the packets in them"""
+
+    def __init__(self, packet_ids):
+        self.layout = sensor_layout(tuple(packet_ids))
+        self.packet_ids = self.layout.packet_ids
+        self.buffer = bytearray()
+        self.skipped_bytes = 0
+        self.bad_frames = 0
+
+    def reset(self):
+        """Forget any partial frame"""
+        self.buffer.clear()
+
+    def feed(self, data: bytes) -> list:
+        """Add bytes read from the robot, and return the records from every complete frame"""
+        layout = self.layout
+        buffer = self.buffer
+        buffer += data
+        frames = []
+        start = 0
+        while True:
+            header = buffer.find(STREAM_HEADER, start)
+            if header == -1:
+                self.skipped_bytes += len(buffer) - start
+                start = len(buffer)
+                break
+            self.skipped_bytes += header - start
+            start = header
+            if len(buffer) - start < layout.frame_size:
+                break
+            frame = buffer[start : start + layout.frame_size]
+            record = None
+            if frame[1] == layout.frame_byte_count and not sum(frame) & 0xFF:
+                record = layout.decode_frame(frame)
+            if record is None:
+                # Probably a 19 in the middle of some data, look for the next one
+                self.bad_frames += 1
+                self.skipped_bytes += 1
+                start += 1
+                continue
+            frames.append(record)
+            start += layout.frame_size
+        del buffer[:start]
+        return frames
+
+
+class SensorStream:
+    """Read the sensor stream on a background thread, and keep the latest frames around"""
+
+    def __init__(self, roomba: serial.Serial, packet_ids, history: int = 256):
+        self.roomba = roomba
+        self.parser = StreamParser(packet_ids)
+        self.history = deque(maxlen=history)
+        self.new_frame = threading.Condition()
+        self.last_frame = None
+        self.on_frames = None
+        """Called with the time and the records on the reading thread, whenever frames come in"""
+        self._thread = None
+        self._running = False
+        self._paused = False
+        self._reading = False
+        """Whether the reading thread is in read() (changed while holding _read_lock)"""
+        self._read_lock = threading.Lock()
+        self._parked = threading.Event()
+        """Set while the reading thread is paused, and not reading anything"""
+        self._resume = threading.Event()
+
+    def start(self):
+        """Ask the robot to start streaming, and start reading frames"""
+        self.roomba.write(self.parser.layout.stream_request)
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._read_frames, daemon=True)
+            self._thread.start()
+
+    @property
+    def running(self) -> bool:
+        """Whether frames are being read"""
+        return self._thread is not None
+
+    def stop(self):
+        """Ask the robot to stop streaming, and stop reading frames"""
+        self._running = False
+        try:
+            self.roomba.write(OPCODE_CHANGE_STREAM_STATUS + b"\x00")
+        except (serial.SerialException, OSError):
+            pass
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.parser.reset()
+
+    def pause(self, timeout: float = 0.5):
+        """
+        Ask the robot to pause streaming, and stop reading without stopping the thread, so something
+        else can read from the port until resume()
+        """
+        self._resume.clear()
+        self._parked.clear()
+        self.roomba.write(OPCODE_CHANGE_STREAM_STATUS + b"\x00")
+        with self._read_lock:
+            self._paused = True
+            if self._reading:
+                # Don't wait for the read that's in progress to time out
+                self.roomba.cancel_read()
+        if self._parked.wait(timeout):
+            self._clear_cancel()
+
+    def _clear_cancel(self):
+        """
+        Throw away a cancel_read() the reading thread didn't use up (if its read finished just as it
+        was sent), since it'd cut short whatever reads from the port next
+        """
+        abort_pipe = getattr(self.roomba, "pipe_abort_read_r", None)
+        if abort_pipe is None:
+            # Not a POSIX port, where cancelling doesn't stick around
+            return
+        try:
+            os.read(abort_pipe, 1000)
+        except (BlockingIOError, OSError):
+            pass
+
+    def resume(self):
+        """Ask the robot to carry on streaming the same packets, and start reading them again"""
+        self.parser.reset()
+        self.roomba.write(OPCODE_CHANGE_STREAM_STATUS + b"\x01")
+        self._paused = False
+        self._resume.set()
+
+    def _read_frames(self):
+        while self._running:
+            with self._read_lock:
+                paused = self._paused
+                self._reading = not paused
+            if paused:
+                self._parked.set()
+                self._resume.wait(0.1)
+                continue
+            try:
+                data = self.roomba.read(max(1, self.roomba.in_waiting))
+            except (serial.SerialException, OSError, TypeError):
+                # The port's probably being reopened
+                time.sleep(0.1)
+                continue
+            finally:
+                with self._read_lock:
+                    self._reading = False
+            if not data:
+                continue
+            frames = self.parser.feed(data)
+            if frames:
+                self._add_frames(time.monotonic(), frames)
+
+    def _add_frames(self, received_at: float, frames: list):
+        with self.new_frame:
+            for record in frames:
+                self.history.append((received_at, record))
+            self.last_frame = (received_at, frames[-1])
+            self.new_frame.notify_all()
+        if self.on_frames is not None:
+            self.on_frames(received_at, frames)
+
+    def latest(self, max_age: float = None):
+        """Get the record from the newest frame, or None if it's older than max_age seconds"""
+        last_frame = self.last_frame
+        if last_frame is None:
+            return None
+        received_at, record = last_frame
+        if max_age is not None and time.monotonic() - received_at > max_age:
+            return None
+        return record
+
+    def wait(self, timeout: float = None):
+        """Wait for the next frame, and get its record (or None if it didn't come in time)"""
+        with self.new_frame:
+            last_frame = self.last_frame
+            self.new_frame.wait_for(lambda: self.last_frame is not last_frame, timeout)
+            if self.last_frame is last_frame:
+                return None
+            return self.last_frame[1]
+
+    def drain(self) -> list:
+        """Get the records from every frame since the last drain, oldest first"""
+        with self.new_frame:
+            frames = [record for _received_at, record in self.history]
+            self.history.clear()
+        return frames
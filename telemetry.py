@@ -0,0 +1,174 @@
+"""
+Remember what the roomba's been doing in a fixed amount of memory, so Home Assistant can ask for it.
+
+Every check from the bridge goes into the newest tier as is. Older tiers keep the average of each
+minute and each 15 minutes, so they go back much further in the same space. Each tier is a ring of
+preallocated arrays, which wrap around and write over the oldest samples once they're full:
+
+- Every check: 2048 of them (at least 17 minutes, since checks are at most every half a second)
+- Every minute: 1440 of them (a day)
+- Every 15 minutes: 2880 of them (a month)
+
+That's about 130KB in total. To get some of it, publish to roomba/history/request:
+
+{"window": 86400, "points": 200}
+
+(or "start" and "end" as Unix times), and it's published on roomba/history as lists of times,
+states, battery levels, how much of the time the wheels were going, and how much of the time it was
+charging. The finest tier that goes back far enough is used, and then averaged down to the points.
+A "response_topic" in the request sends it there instead.
+"""
+import math
+from array import array
+
+STATES = ("cleaning", "docked", "paused", "idle", "returning", "error")
+STATE_CODES = {state: code for code, state in enumerate(STATES)}
+TIERS = (
+    (0, 2048),
+    (60, 1440),
+    (900, 2880),
+)
+"""How many seconds each sample in a tier covers (0 is every check), and how many it keeps"""
+DEFAULT_POINTS = 200
+MAX_POINTS = 2000
+
+
+class Tier:
+    """A ring of samples at one resolution"""
+
+    def __init__(self, resolution: float, capacity: int):
+        self.resolution = resolution
+        self.capacity = capacity
+        self.times = array("d", bytes(8 * capacity))
+        self.states = array("B", bytes(capacity))
+        self.battery = array("f", bytes(4 * capacity))
+        self.moving = array("f", bytes(4 * capacity))
+        self.charging = array("f", bytes(4 * capacity))
+        self.next = 0
+        self.count = 0
+        # The samples in the bucket that isn't finished yet
+        self.bucket = None
+        self.bucket_count = 0
+        self.bucket_battery = 0.0
+        self.bucket_moving = 0.0
+        self.bucket_charging = 0.0
+        self.bucket_state = 0
+        self.bucket_time = 0.0
+
+    def _store(self, time, state, battery, moving, charging):
+        index = self.next
+        self.times[index] = time
+        self.states[index] = state
+        self.battery[index] = battery
+        self.moving[index] = moving
+        self.charging[index] = charging
+        self.next = (index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def _pending(self):
+        count = self.bucket_count
+        return (
+            self.bucket_time,
+            self.bucket_state,
+            self.bucket_battery / count,
+            self.bucket_moving / count,
+            self.bucket_charging / count,
+        )
+
+    def add(self, time: float, state: int, battery: float, moving: float, charging: float):
+        """Add a sample (averaging it into the current bucket if this tier has them)"""
+        if not self.resolution:
+            self._store(time, state, battery, moving, charging)
+            return
+        bucket = math.floor(time / self.resolution)
+        if bucket != self.bucket:
+            if self.bucket_count:
+                self._store(*self._pending())
+            self.bucket = bucket
+            self.bucket_count = 0
+            self.bucket_battery = self.bucket_moving = self.bucket_charging = 0.0
+        self.bucket_count += 1
+        self.bucket_battery += battery
+        self.bucket_moving += moving
+        self.bucket_charging += charging
+        # The state's the one it was in at the end of the bucket, and so is the time
+        self.bucket_state = state
+        self.bucket_time = time
+
+    def oldest(self) -> float:
+        """The time of the oldest sample, or None if there aren't any"""
+        if self.count:
+            return self.times[(self.next - self.count) % self.capacity]
+        if self.bucket_count:
+            return self.bucket_time
+        return None
+
+    def rows(self, start: float, end: float) -> list:
+        """Every sample from start to end, oldest first"""
+        rows = []
+        first = self.next - self.count
+        for offset in range(self.count):
+            index = (first + offset) % self.capacity
+            if start <= self.times[index] <= end:
+                rows.append(
+                    (
+                        self.times[index],
+                        self.states[index],
+                        self.battery[index],
+                        self.moving[index],
+                        self.charging[index],
+                    )
+                )
+        if self.bucket_count and start <= self.bucket_time <= end:
+            rows.append(self._pending())
+        return rows
+
+
+class TelemetryHistory:
+    """Every tier, added to together"""
+
+    def __init__(self, tiers=TIERS):
+        self.tiers = [Tier(resolution, capacity) for resolution, capacity in tiers]
+
+    def add(self, time: float, state: str, battery: float, moving: bool, charging: bool):
+        """Add a check from the bridge"""
+        code = STATE_CODES.get(state, STATE_CODES["error"])
+        for tier in self.tiers:
+            tier.add(time, code, battery, float(moving), float(charging))
+
+    def query(self, start: float, end: float, points: int = DEFAULT_POINTS) -> dict:
+        """Get up to points samples from start to end, from the finest tier that goes back enough"""
+        points = max(1, min(points, MAX_POINTS))
+        tiers = [tier for tier in self.tiers if tier.oldest() is not None]
+        if not tiers:
+            tier = self.tiers[0]
+        else:
+            covering = [tier for tier in tiers if tier.oldest() <= start]
+            # If none of them go back that far, use the one that goes back furthest
+            tier = covering[0] if covering else min(tiers, key=Tier.oldest)
+        rows = tier.rows(start, end)
+        resolution = tier.resolution
+        if len(rows) > points:
+            # Average groups of them together
+            size = math.ceil(len(rows) / points)
+            rows = [_average(rows[index : index + size]) for index in range(0, len(rows), size)]
+            resolution = max(resolution, (end - start) / points)
+        return {
+            "resolution": resolution,
+            "time": [round(row[0], 3) for row in rows],
+            "state": [STATES[row[1]] for row in rows],
+            "battery_level": [round(row[2] * 100, 1) for row in rows],
+            "moving": [round(row[3], 3) for row in rows],
+            "charging": [round(row[4], 3) for row in rows],
+        }
+
+
+def _average(rows: list) -> tuple:
+    count = len(rows)
+    return (
+        rows[-1][0],
+        rows[-1][1],
+        sum(row[2] for row in rows) / count,
+        sum(row[3] for row in rows) / count,
+        sum(row[4] for row in rows) / count,
+    )
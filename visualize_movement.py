@@ -1,45 +1,207 @@
 """
-Visualize the local file movement.json, containing a previous log of the roomba's movement.
+Visualize a previous log of the roomba's movement.
 
-The file format is a JSON file, with the following columns:
+The log can be a movement directory (from record_movement.py), a binary movement file (.fmov), or an
+old movement.json. Each sample has the following keys:
 
 - Amount that the Roomba has moved forwards/backwards (encoder_delta)
 - Amount that the Roomba has turned left/right (left is positive, right is negative, degrees_turned)
 - Light bumper (true/false, light_bumper)
 - Cliff (true/false, cliff)
 - Bumper/wheel drop (true/false, bumper_wheel_drop)
+
+The whole path is worked out at once, so it can be saved straight to a PNG or SVG without a display:
+
+python3 visualize_movement.py movement -o movement.svg
 """
-import ujson, turtle
+import argparse
+import os
+
+import numpy as np
+import ujson
+
+from movement_binary import MovementFile
+from movement_log import DEFAULT_DURATION, read_movement
+
+DISTANCE_SCALE = 1 / 50
+"""How far to draw the path for each encoder count"""
+EVENT_COLORS = {
+    "bumper_wheel_drop": (1, 0.4, 0.4),
+    "cliff": (1, 0.4, 1),
+    "light_bumper": (1, 1, 0.4),
+}
+LEGEND = (
+    ("bumper/drop", (1, 0.4, 0.4)),
+    ("cliff sensor", (1, 0.4, 1)),
+    ("light bumper", (0.9, 0.9, 0)),
+)
+COLUMNS = ("encoder_delta", "degrees_turned", "light_bumper", "cliff", "bumper_wheel_drop")
+
+
+def load_movement(path: str) -> dict:
+    """Load a log into a NumPy array for each column (and how long each sample covers, duration)"""
+    if path.endswith(".fmov"):
+        movement_file = MovementFile(path)
+        movement = {column: getattr(movement_file, column) for column in COLUMNS}
+        movement["duration"] = movement_file.duration
+        return movement
+    if os.path.isdir(path):
+        samples = list(read_movement(path))
+    else:
+        with open(path) as f:
+            samples = ujson.load(f)
+    movement = {
+        column: np.fromiter(
+            (sample[column] for sample in samples),
+            np.float64 if column in ("encoder_delta", "degrees_turned") else bool,
+            count=len(samples),
+        )
+        for column in COLUMNS
+    }
+    movement["duration"] = np.fromiter(
+        (sample.get("duration", DEFAULT_DURATION) for sample in samples),
+        np.float64,
+        count=len(samples),
+    )
+    return movement
+
+
+def integrate_path(movement: dict, distance_scale: float = DISTANCE_SCALE):
+    """
+    Work out where the Roomba was after each sample.
+
+    Each sample turns first and then moves, so the heading is the running total of degrees_turned,
+    and the position is the running total of each move in the direction it was facing.
+    Returns the heading (in degrees), x, and y, starting at the origin
+    (so they're 1 longer than the log).
+    """
+    heading = np.concatenate(([0.0], np.cumsum(movement["degrees_turned"], dtype=np.float64)))
+    distance = np.asarray(movement["encoder_delta"], dtype=np.float64) * distance_scale
+    radians = np.radians(heading[1:])
+    x = np.concatenate(([0.0], np.cumsum(distance * np.cos(radians))))
+    y = np.concatenate(([0.0], np.cumsum(distance * np.sin(radians))))
+    return heading, x, y
+
+
+def find_events(movement: dict) -> dict:
+    """Find which samples to mark for each event (each sample only gets its most important one)"""
+    bumper_wheel_drop = np.asarray(movement["bumper_wheel_drop"], dtype=bool)
+    cliff = np.asarray(movement["cliff"], dtype=bool) & ~bumper_wheel_drop
+    light_bumper = np.asarray(movement["light_bumper"], dtype=bool) & ~bumper_wheel_drop & ~cliff
+    return {
+        "bumper_wheel_drop": np.flatnonzero(bumper_wheel_drop) + 1,
+        "cliff": np.flatnonzero(cliff) + 1,
+        "light_bumper": np.flatnonzero(light_bumper) + 1,
+    }
+
+
+def _hex(color) -> str:
+    return "#" + "".join(f"{round(channel * 255):02x}" for channel in color)
+
 
-with open("movement.json") as f:
-    movement = ujson.load(f)
+def render_svg(path: str, x, y, events: dict, margin: float = 20):
+    """Save the path to an SVG"""
+    left, right = min(x.min(), 0), max(x.max(), 0)
+    bottom, top = min(y.min(), 0), max(y.max(), 0)
+    width = right - left + margin * 2
+    height = top - bottom + margin * 2
+    # SVGs go down from the top, so flip it
+    svg_x = x - left + margin
+    svg_y = top - y + margin
+    points = " ".join(f"{px:.2f},{py:.2f}" for px, py in zip(svg_x.tolist(), svg_y.tolist()))
+    with open(path, "w") as f:
+        f.write(
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.0f}" height="{height:.0f}"'
+            f' viewBox="0 0 {width:.2f} {height:.2f}">\n'
+        )
+        f.write('<rect width="100%" height="100%" fill="white"/>\n')
+        f.write(
+            f'<polyline points="{points}" fill="none" stroke="black" stroke-width="5"'
+            ' stroke-linejoin="round" stroke-linecap="round"/>\n'
+        )
+        for event, indexes in events.items():
+            color = _hex(EVENT_COLORS[event])
+            for index in indexes.tolist():
+                f.write(
+                    f'<circle cx="{svg_x[index]:.2f}" cy="{svg_y[index]:.2f}" r="5"'
+                    f' fill="{color}"/>\n'
+                )
+        for row, (label, color) in enumerate(LEGEND):
+            f.write(
+                f'<text x="{margin:.0f}" y="{margin + row * 20:.0f}" fill="{_hex(color)}"'
+                f' font-family="sans-serif" font-size="14">{label}</text>\n'
+            )
+        f.write("</svg>\n")
+
+
+def render_png(path: str, x, y, events: dict, dpi: int = 100):
+    """Save the path to a PNG"""
+    import matplotlib
+
+    matplotlib.use("Agg")  # Works without a display
+    from matplotlib import pyplot as plt
+
+    figure, axes = plt.subplots(figsize=(8, 8))
+    axes.plot(x, y, color="black", linewidth=2.5, solid_capstyle="round")
+    for event, indexes in events.items():
+        axes.scatter(x[indexes], y[indexes], s=25, color=EVENT_COLORS[event], zorder=3)
+    for label, color in LEGEND:
+        axes.plot([], [], "o", color=color, label=label)
+    axes.legend(loc="upper right")
+    axes.set_aspect("equal", adjustable="datalim")
+    axes.axis("off")
+    figure.savefig(path, dpi=dpi, bbox_inches="tight")
+    plt.close(figure)
+
+
+def render_turtle(x, y, events: dict):
+    """Draw the path in a turtle window, all at once"""
+    import turtle
+
+    turtle.tracer(0)
+    turtle.hideturtle()
     turtle.penup()
-    turtle.goto(400, 400)
-    turtle.color(1, 0.4, 0.4)
-    turtle.write("bumper/drop")
-    turtle.goto(400, 380)
-    turtle.color(1, 0.4, 1)
-    turtle.write("cliff sensor")
-    turtle.goto(400, 360)
-    turtle.color(0.9, 0.9, 0)
-    turtle.write("light bumper")
+    for row, (label, color) in enumerate(LEGEND):
+        turtle.goto(400, 400 - row * 20)
+        turtle.color(*color)
+        turtle.write(label)
     turtle.home()
-    for movement_step in movement:
-        turtle.color("black")
-        turtle.pensize(5)
-        turtle.pendown()
-        turtle.setheading(turtle.heading() + movement_step["degrees_turned"])
-        turtle.forward(movement_step["encoder_delta"] / 50)
-        turtle.penup()
-        turtle.update()
-        if movement_step["bumper_wheel_drop"]:
-            turtle.color(1, 0.4, 0.4)
-            turtle.dot(10)
-        elif movement_step["cliff"]:
-            turtle.color(1, 0.4, 1)
-            turtle.dot(10)
-        elif movement_step["light_bumper"]:
-            turtle.color(1, 1, 0.4)
+    turtle.color("black")
+    turtle.pensize(5)
+    turtle.pendown()
+    for point in zip(x.tolist(), y.tolist()):
+        turtle.goto(point)
+    turtle.penup()
+    for event, indexes in events.items():
+        turtle.color(*EVENT_COLORS[event])
+        for index in indexes.tolist():
+            turtle.goto(x[index], y[index])
             turtle.dot(10)
+    turtle.update()
+    turtle.done()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "log",
+        nargs="?",
+        default="movement" if os.path.isdir("movement") else "movement.json",
+        help="movement directory, .fmov file, or movement.json",
+    )
+    parser.add_argument("-o", "--output", help="save to a .png or .svg instead of opening a window")
+    args = parser.parse_args()
+
+    movement = load_movement(args.log)
+    _heading, x, y = integrate_path(movement)
+    events = find_events(movement)
+    if args.output is None:
+        render_turtle(x, y, events)
+    elif args.output.endswith(".svg"):
+        render_svg(args.output, x, y, events)
+    else:
+        render_png(args.output, x, y, events)
+
 
-turtle.done()
+if __name__ == "__main__":
+    main()